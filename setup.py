@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import re
 from setuptools import setup
 from codecs import open
 from os import path
 
-import sudoku
-
 here = path.abspath(path.dirname(__file__))
 
+# Read the version without importing sudoku, which needs Python 3.9.
+with open(path.join(here, 'sudoku.py'), encoding='utf-8') as f:
+    version = re.search(r"^__version__ = '(.*)'", f.read(), re.M).group(1)
+
 # Get the long description from the relevant file
 # with open(path.join(here, 'DESCRIPTION.rst'), encoding='utf-8') as f:
 #     long_description = f.read()
@@ -15,7 +18,7 @@ here = path.abspath(path.dirname(__file__))
 setup(
     name='SudokuPuzzle',
 
-    version=sudoku.__version__,
+    version=version,
 
     description='Sudoku puzzle generator and solver',
     # long_description=long_description,
@@ -32,17 +35,21 @@ setup(
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Games/Entertainment :: Puzzle Games',
     ],
 
     keywords='sudoku',
 
+    python_requires='>=3.9',
+
     extras_require={
+        'numpy': ['numpy'],
         'test': ['pytest'],
     },
 )
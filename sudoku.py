@@ -13,7 +13,22 @@ And then the classes became all about supporting GUIs, such as
 the PyQt QML one at: https://github.com/pkobrien/qml-sudoku
 """
 
+import array
+import collections
+import contextlib
+import functools
+import itertools
+import os
 import random
+import sys
+import threading
+import time
+import weakref
+
+# Modules that only some functions need, such as asyncio, argparse,
+# concurrent.futures and NumPy (an optional extra only needed by
+# solve_batch()), are imported inside them, to keep importing sudoku quick
+# for the Puzzle classes.
 
 __version__ = '1.0.0'
 
@@ -86,39 +101,262 @@ PEERS = [peer_indices(i) for i in range(81)]
 UNITS = [unit_indices(i) for i in range(81)]
 
 
+# The bitmask engine stores the possible digits for a square as a 9-bit int,
+# with bit n set if digit n + 1 is still possible.
+
+ALL_DIGITS_MASK = 0x1ff
+
+DIGIT_MASKS = {str(n + 1): 1 << n for n in range(9)}
+
+MASK_COUNTS = [bin(mask).count('1') for mask in range(512)]
+
+MASK_DIGITS = [''.join(str(n + 1) for n in range(9) if mask & (1 << n))
+               for mask in range(512)]
+
+BIT_INDEX = [0] * 512
+for _n in range(9):
+    BIT_INDEX[1 << _n] = _n
+del _n
+
+UNIT_SQUARES = [list(unit) for unit in ROWS + COLUMNS + BOXES]
+
+
+def unit_slots(i):
+    """Return (unit, base, position_bit) triples for the units of square i.
+
+    A bitmask board is a flat list of 81 square masks followed by 27 * 9
+    digit-position masks, one per (unit, digit) pair. Bit p of the mask at
+    board[base + n] is set if digit n + 1 is still possible for the p-th
+    square of the unit."""
+    return tuple((u, 81 + 9 * u, 1 << unit.index(i))
+                 for u, unit in enumerate(UNIT_SQUARES) if i in unit)
+
+
+SLOTS = [unit_slots(i) for i in range(81)]
+
+PEER_LISTS = [sorted(PEERS[i]) for i in range(81)]
+
+ENGINES = {'bitmask', 'dlx', 'iterative', 'norvig'}
+
+STRATEGIES = ('naked_pairs', 'hidden_pairs', 'pointing', 'box_line',
+              'naked_triples', 'hidden_triples', 'x_wing')
+
+# Techniques used by rate(), easiest first, with the score for each use.
+TECHNIQUES = (('naked_single', 1), ('hidden_single', 2), ('pointing', 4),
+              ('box_line', 5), ('naked_pairs', 6), ('hidden_pairs', 8),
+              ('naked_triples', 10), ('hidden_triples', 12), ('x_wing', 15),
+              ('search', 25))
+
+# Grid sizes supported, and the digits used (in order) by a size x size grid.
+SIZES = (4, 9, 16, 25)
+
+SYMBOLS = '123456789ABCDEFGHIJKLMNOP'
+
+# The packed format stores a 9x9 grid in 41 bytes, with 4 bits per square
+# holding its digit, or 0 if unassigned. A file of them starts with a
+# PACKED_HEADER_BYTES header: PACKED_MAGIC, the format version, flags (bit 0
+# set if each grid is followed by its solution) and two spare bytes.
+PACKED_GRID_BYTES = 41
+
+PACKED_HEADER_BYTES = 8
+
+PACKED_MAGIC = b'SDK4'
+
+PACKED_VERSION = 1
+
+_PACK_CHARS = bytes.maketrans(b'.123456789', bytes(range(10)))
+
+_UNPACK_CHARS = b'.123456789' + b'?' * 246
+
+_LOW_NIBBLES = int.from_bytes(b'\x0f' * PACKED_GRID_BYTES, 'big')
+
+# The mask for a square's digit, or for its value in a packed record.
+_VALUE_MASKS = {key: mask for digit, mask in DIGIT_MASKS.items()
+                for key in (digit, int(digit))}
+
+_ASYNC_RUNNER = []  # Filled in by _async_runner() when first used.
+
+_DLX_TEMPLATE = []  # Filled in by _dlx_links() when DLX is first used.
+
+_NP_TABLES = {}  # Filled in by _np_tables() when NumPy is first used.
+
+_PARALLEL_CANCEL = []  # Filled in by _parallel_init() in worker processes.
+
+_RATINGS = collections.OrderedDict()  # Filled in by _rate_canonical().
+
+_SEARCH_POOLS = {}  # Filled in by _search_pool() for each workers used.
+
+_SIZE_TABLES = {}  # Filled in by _size_tables() for each size used.
+
+_TOPOLOGIES = {}  # Filled in by _topology() for each size used.
+
+
 #==============================================================================
 # Public API
 #==============================================================================
 
 
-def display(grid):
+async def async_random_grid(min_assigned_squares=26, symmetrical=True,
+                            timeout=None, runner=None, **kwargs):
+    """Return random_grid() made on runner's executor, without blocking.
+
+    The runner is an AsyncRunner, or a default one shared by all callers.
+    If the task is cancelled, or takes more than timeout seconds, the
+    worker stops making the grid and the task raises CancelledError (or
+    TimeoutError). Other keyword arguments are passed to random_grid()."""
+    runner = runner or _async_runner()
+    return await _async_wait(runner.run(
+        random_grid, min_assigned_squares, symmetrical, **kwargs), timeout)
+
+
+async def async_solve(grid, max_solutions=None, timeout=None, runner=None,
+                      **kwargs):
+    """Return a list of up to max_solutions solutions for grid.
+
+    The search runs on runner's executor and is stopped as for
+    async_random_grid(). Other keyword arguments are passed to solve()."""
+    runner = runner or _async_runner()
+    return await _async_wait(runner.run(
+        _solve_list, grid, max_solutions, **kwargs), timeout)
+
+
+def canonical_form(grid):
+    """Return (canonical_grid, transform) for grid.
+
+    Grids that are the same up to relabeling digits, transposing, and
+    reordering bands, stacks, and the rows and columns within them, give
+    the same canonical grid, as long as the invariants used to order the
+    rows and columns are not tied. Tied grids just give different, but
+    still equivalent, canonical grids. The transform is a (squares, relabel)
+    pair: canonical square k comes from grid square squares[k], and relabel
+    maps each digit of grid to its canonical digit. Use from_canonical() to
+    apply the transform in reverse."""
+    grid = normalize(grid)
+    row_keys, column_keys = _line_keys(grid)
+    row_bands = _band_keys(row_keys)
+    column_bands = _band_keys(column_keys)
+    transposed = ((sorted(column_bands), sorted(row_bands)) <
+                  (sorted(row_bands), sorted(column_bands)))
+    if transposed:
+        row_keys, column_keys = column_keys, row_keys
+        row_bands, column_bands = column_bands, row_bands
+    row_order = _line_order(row_keys, row_bands)
+    column_order = _line_order(column_keys, column_bands)
+    if transposed:
+        squares = [9 * c + r for r in row_order for c in column_order]
+    else:
+        squares = [9 * r + c for r in row_order for c in column_order]
+    relabel = {}
+    for i in squares:
+        if grid[i] != '.' and grid[i] not in relabel:
+            relabel[grid[i]] = str(len(relabel) + 1)
+    unused = sorted(DIGITS - set(relabel.values()))
+    relabel.update(zip(sorted(DIGITS - set(relabel)), unused))
+    canonical_grid = ''.join(relabel.get(grid[i], '.') for i in squares)
+    return canonical_grid, (squares, relabel)
+
+
+def count_solutions(grid, limit=None, engine='bitmask', size=9):
+    """Return the number of solutions for grid, counting no more than limit.
+
+    Faster than counting what solve() generates, since no solution is
+    turned into a grid string, and the search stops once limit is hit.
+    The engine is 'bitmask' (the default) or 'dlx'."""
+    _check_engine(engine)
+    _check_size(size, engine)
+    if engine not in ('bitmask', 'dlx'):
+        raise ValueError("Counting needs the 'bitmask' or 'dlx' engine.")
+    if (isinstance(grid, (bytes, bytearray, memoryview)) and size == 9 and
+            engine == 'bitmask'):
+        # As for solve(), propagating finds any repeated digit.
+        board = _bits_propagated(_packed_values(grid))
+        if limit is not None and limit < 1 or not board:
+            return 0
+        return _bits_count(board, [], limit)
+    grid = normalize(grid, size)
+    if limit is not None and limit < 1 or not is_valid(grid, size):
+        return 0
+    if size != 9:
+        tables = _size_tables(size)
+        board = _sized_propagated(tables, grid)
+        if not board:
+            return 0
+        return sum(1 for solved_board in
+                   itertools.islice(_sized_solve(tables, board), limit))
+    if engine == 'dlx':
+        links = _dlx_choose(_dlx_links(), grid)
+        if not links:
+            return 0
+        return sum(1 for chosen in
+                   itertools.islice(_dlx_solve(links, []), limit))
+    board = _bits_propagated(grid)
+    if not board:
+        return 0
+    return _bits_count(board, [], limit)
+
+
+def count_solutions_parallel(grid, limit=None, workers=None, pool=None):
+    """Return count_solutions(grid, limit), counted on a pool of processes.
+
+    The search is split up as for solve_parallel(), and the counts of the
+    subtrees added up, with the other workers stopped once limit is hit."""
+    counts = _parallel_search(grid, limit, workers, True, pool)
+    total = sum(count for count in counts if count is not None)
+    return total if limit is None else min(total, limit)
+
+
+def display(grid, size=9):
     """Print grid in a readable format."""
-    print(formatted(grid))
+    print(formatted(grid, size))
 
 
-def formatted(grid):
+def formatted(grid, size=9):
     """Return grid in a readable format."""
-    grid = normalize(grid)
+    grid = normalize(grid, size)
+    side = int(round(size ** 0.5))
+    edges = range(side - 1, size - 1, side)
     width = 2
-    border = '+'.join(['-' * (1 + (width * 3))] * 3)
+    border = '+'.join(['-' * (1 + (width * side))] * side)
     lines = []
-    rows = [grid[n:n+9] for n in range(0, 81, 9)]
+    rows = [grid[n:n+size] for n in range(0, size * size, size)]
     for n, row in enumerate(rows):
         line = ' ' + ''.join(
-            row[n2].center(width) + ('| ' if n2 in (2, 5) else '')
-            for n2 in range(9))
+            row[n2].center(width) + ('| ' if n2 in edges else '')
+            for n2 in range(size))
         lines.append(line)
-        if n in (2, 5):
+        if n in edges:
             lines.append(border)
     return '\n' + '\n'.join(lines) + '\n'
 
 
-def is_valid(grid):
+def from_canonical(grid, transform):
+    """Return grid (in canonical form) transformed back by transform.
+
+    Used to turn the solution of a canonical grid into the solution of the
+    grid that canonical_form() was given."""
+    squares, relabel = transform
+    digits = {canonical: digit for digit, canonical in relabel.items()}
+    digits['.'] = '.'
+    result = [None] * 81
+    for k, i in enumerate(squares):
+        result[i] = digits[grid[k]]
+    return ''.join(result)
+
+
+def has_unique_solution(grid):
+    """Return True if grid has one and only one solution."""
+    return count_solutions(grid, 2) == 1
+
+
+def is_valid(grid, size=9):
     """Return true if grid has no duplicate values within a unit.
 
     Does not guarantee that grid can be solved."""
-    grid = normalize(grid)
-    units = ROWS + COLUMNS + BOXES
+    grid = normalize(grid, size)
+    if size == 9:
+        units = ROWS + COLUMNS + BOXES
+    else:
+        units = _size_tables(size)['units']
     for unit in units:
         values = [grid[i] for i in unit if grid[i] != '.']
         if len(values) != len(set(values)):
@@ -126,8 +364,22 @@ def is_valid(grid):
     return True
 
 
-def normalize(grid):
-    """Return 81 character string of digits (with dots for missing values)."""
+def normalize(grid, size=9):
+    """Return 81 character string of digits (with dots for missing values).
+
+    Grids of the other SIZES are size * size characters, using the first
+    size characters of SYMBOLS as digits (in either case). A 9x9 grid can
+    also be a packed record, as made by pack_grid()."""
+    if isinstance(grid, (bytes, bytearray, memoryview)) and size == 9:
+        return unpack_grid(grid)
+    if size != 9:
+        tables = _size_tables(size)
+        valid_chars = tables['valid_chars']
+        normalized = ''.join([c for c in grid if c in valid_chars])
+        normalized = normalized.upper().replace('0', '.')
+        if len(normalized) != tables['squares']:
+            raise ValueError('Grid is not a proper text representation.')
+        return normalized
     normalized = ''.join([c for c in grid if c in VALID_GRID_CHARS])
     normalized = normalized.replace('0', '.')
     if len(normalized) != 81:
@@ -135,32 +387,338 @@ def normalize(grid):
     return normalized
 
 
-def random_grid(min_assigned_squares=26, symmetrical=True):
+def pack_grid(grid):
+    """Return grid packed into PACKED_GRID_BYTES bytes, 4 bits per square.
+
+    Square 2k is the high nibble of byte k and square 2k + 1 the low one.
+    A record that is already packed is copied as is."""
+    if isinstance(grid, (bytes, bytearray, memoryview)):
+        if len(grid) != PACKED_GRID_BYTES:
+            raise ValueError('Packed grid is not %d bytes.'
+                             % PACKED_GRID_BYTES)
+        return bytes(grid)
+    values = normalize(grid).encode('ascii').translate(_PACK_CHARS) + b'\0'
+    # No nibble is over 9, so shifting the high ones never carries over.
+    packed = (int.from_bytes(values[0::2], 'big') << 4 |
+              int.from_bytes(values[1::2], 'big'))
+    return packed.to_bytes(PACKED_GRID_BYTES, 'big')
+
+
+def random_rated_grid(technique, min_assigned_squares=17, symmetrical=True,
+                      workers=None, chunksize=1, cancel=None, deadline=None,
+                      max_attempts=1000):
+    """Return a random (grid, solution) pair whose hardest technique, as
+    rated by rate(), is technique.
+
+    Candidate grids are dug (see random_grid) and rated on a pool of worker
+    processes, and the first that matches is returned. Some techniques are
+    rarely the hardest one needed, so no more than max_attempts candidates
+    are made (None for no limit). As for random_grid(), BudgetExhausted is
+    raised when that or the deadline is reached, and SearchCancelled when
+    cancel is set, once the candidates already being rated are done."""
+    if technique not in dict(TECHNIQUES):
+        raise ValueError('Unknown technique %r.' % (technique,))
+    limit = _search_limit(cancel=cancel, deadline=deadline,
+                          max_attempts=max_attempts)
+    stopped = []
+
+    def seeds():
+        while True:
+            if limit is not None:
+                try:
+                    limit.check_attempt()
+                except SearchCancelled as e:
+                    stopped.append(e)
+                    return
+            yield random.getrandbits(64)
+
+    make = functools.partial(_rated_dug_grid,
+                             min_assigned_squares=min_assigned_squares,
+                             symmetrical=symmetrical)
+    for n, (grid, solution, rating) in _pool_map(make, seeds(), workers,
+                                                 chunksize, ordered=False):
+        if rating[1] == technique:
+            return grid, solution
+    raise stopped[0]
+
+
+def random_grid(min_assigned_squares=26, symmetrical=True, engine='bitmask',
+                stats=None, method='assign', strategies=None, size=9,
+                cancel=None, deadline=None, max_attempts=None):
     """Return a random (grid, solution) pair.
 
     Assign a minimum of 17 to a maximum of 80 squares.
-    Assigning less than 26 squares can take a long time."""
+    Assigning less than 26 squares can take a long time.
+    Pass a SearchStats instance as stats to count the work done.
+
+    With method='dig' a random solution is made first and clues are then
+    removed from it for as long as the grid keeps a single solution, which
+    takes a predictable time whatever the number of squares. The grid will
+    have more than min_assigned_squares squares assigned if no more clues
+    can be removed.
+
+    Strategies are used by the uniqueness checks, as for solve(). Only the
+    'norvig' engine has its own generator; the others share the bitmask
+    one.
+
+    Grids of the other SIZES are always made by digging holes in a random
+    solution, down to min_assigned_squares (from 0 to size * size). With
+    method='assign' every hole can be filled in as a single, which is
+    quick even for 25x25 grids, while 'dig' digs more holes but takes
+    seconds (tens of them for 25x25). Either way the grid has a single
+    solution.
+
+    As for solve(), setting a threading.Event passed as cancel raises
+    SearchCancelled, and passing the deadline raises BudgetExhausted, as
+    does needing more than max_attempts attempts. These are checked
+    between attempts and holes, and at each node of the uniqueness
+    checks. Digging holes, for method='dig' or the other SIZES, counts as
+    one attempt."""
+    _check_engine(engine)
+    _check_stats(engine, stats)
+    strategies = _check_strategies(engine, strategies)
+    _check_size(size, engine, stats, strategies)
+    if method not in ('assign', 'dig'):
+        raise ValueError("Unknown method %r, expected 'assign' or 'dig'."
+                         % (method,))
+    limit = _search_limit(stats, cancel, deadline, max_attempts=max_attempts)
+    if size != 9:
+        tables = _size_tables(size)
+        min_assigned_squares = min(max(min_assigned_squares, 0),
+                                   tables['squares'])
+        return _sized_dug_grid(tables, min_assigned_squares, symmetrical,
+                               method, limit)
+    if method == 'dig':
+        if engine != 'bitmask' or stats is not None:
+            raise ValueError('Digging needs the bitmask engine, '
+                             'without stats.')
+        return _bits_dug_grid(min_assigned_squares, symmetrical, strategies,
+                              limit)
+    if engine == 'norvig' and stats is None and not strategies:
+        attempt = functools.partial(_random_grid, limit=limit)
+    else:
+        attempt = functools.partial(_bits_random_grid, stats=stats,
+                                    strategies=strategies, limit=limit)
     result = False
     while not result:
         # Failed to setup a single-solution grid, so try again.
-        result = _random_grid(min_assigned_squares, symmetrical)
+        if limit is not None:
+            limit.check_attempt()
+        result = attempt(min_assigned_squares, symmetrical)
+    if stats is not None:
+        stats._finished()
     return result
 
 
-def solve(grid):
-    """Generate all possible solutions for a solveable grid."""
-    grid = normalize(grid)
-    if not is_valid(grid):
-        # We can't solve an invalid grid.
+def rate(grid):
+    """Return (score, hardest_technique) for solving grid like a person.
+
+    The easiest technique in TECHNIQUES that makes progress is applied
+    each time, until the grid is solved. The score adds up the score of
+    each technique used, and is higher for harder grids. If nothing but
+    'search' would help, the grid is given the score for it and left at
+    that. Return None if grid does not have one and only one solution."""
+    return _rate_canonical(canonical_form(grid)[0])
+
+
+def rate_many(grids, workers=None, chunksize=64):
+    """Generate rate(grid) for each grid, in the order given.
+
+    Like solve_many(), the work is spread over a pool of worker processes,
+    and a grid that is not a proper text representation gives None. Grids
+    that are equivalent to ones already rated by the same worker (see
+    canonical_form) are not rated again."""
+    for n, rating in _pool_map(_rate_one, grids, workers, chunksize):
+        yield rating
+
+
+def solve(grid, engine='bitmask', stats=None, strategies=None, size=9,
+          cancel=None, deadline=None, max_nodes=None):
+    """Generate all possible solutions for a solveable grid.
+
+    The engine is 'bitmask' (the default), 'iterative', which works the
+    same way without any recursion, 'norvig', the original string-based
+    engine, or 'dlx', an exact cover search with dancing links, which is
+    often faster at enumerating many solutions. They all generate the same
+    solutions, though 'dlx' generates them in a different order.
+    Pass a SearchStats instance as stats to count the work done.
+
+    Strategies are names from STRATEGIES (or 'all' of them) to be run to a
+    fixed point before each branch of the search, on top of the naked and
+    hidden singles found by propagation. Each trades time spent deducing
+    for a smaller search tree; stats.strategy_hits shows how well.
+
+    Grids of the other SIZES (see normalize()) are solved without recursion
+    by the bitmask engine, with no stats or strategies.
+
+    Pass a threading.Event as cancel to be able to stop the search from
+    another thread: once it is set, SearchCancelled is raised. To bound
+    the search, pass a time.time() value as deadline, or the most search
+    nodes to visit as max_nodes: going past either raises BudgetExhausted,
+    with the stats so far. A node is each board the search reaches: the
+    propagated grid, and then each digit tried that propagation doesn't
+    rule out straight away. The 'bitmask', 'iterative' and 'norvig'
+    engines (and the other SIZES) all count the same nodes, but 'dlx'
+    also picks the squares the others fill in by propagation one node at
+    a time, so it needs many more."""
+    _check_engine(engine)
+    _check_stats(engine, stats)
+    strategies = _check_strategies(engine, strategies)
+    _check_size(size, engine, stats, strategies)
+    limit = _search_limit(stats, cancel, deadline, max_nodes)
+    if (isinstance(grid, (bytes, bytearray, memoryview)) and size == 9 and
+            engine in ('bitmask', 'iterative')):
+        # Propagate the record's values as they are: a digit repeated in a
+        # unit just leaves its board with a contradiction.
+        grid = _packed_values(grid)
+    else:
+        grid = normalize(grid, size)
+        if not is_valid(grid, size):
+            # We can't solve an invalid grid.
+            return
+    if size != 9:
+        tables = _size_tables(size)
+        board = _sized_propagated(tables, grid)
+        if not board:
+            # Although the grid was valid, it wasn't well-formed.
+            return
+        for solved_board in _sized_solve(tables, board, limit=limit):
+            yield _sized_to_grid(tables, solved_board)
+        return
+    if engine == 'bitmask':
+        try:
+            board = _bits_propagated(grid, stats)
+            if not board:
+                # Although the grid was valid, it wasn't well-formed.
+                return
+            for solved_board in _bits_solve(board, None, stats,
+                                            strategies=strategies,
+                                            limit=limit):
+                yield _bits_to_grid(solved_board)
+        finally:
+            if stats is not None:
+                stats._finished()
+        return
+    elif engine == 'dlx':
+        links = _dlx_choose(_dlx_links(), grid)
+        if not links:
+            return
+        for chosen in _dlx_solve(links, [], limit):
+            yield _dlx_to_grid(grid, chosen)
+        return
+    elif engine == 'iterative':
+        board = _iter_propagated(grid)
+        if not board:
+            # Although the grid was valid, it wasn't well-formed.
+            return
+        for solved_board in _iter_solve(board, limit=limit):
+            yield _bits_to_grid(solved_board)
         return
-    grid_map = _grid_map_propogated(grid)
+    grid_map = _grid_map_propogated(grid, engine)
     if not grid_map:
         # Although the grid was valid, it wasn't well-formed.
         return
-    for solved_grid_map in _solve(grid_map):
+    for solved_grid_map in _solve(grid_map, limit):
         yield _to_grid(solved_grid_map)
 
 
+def solve_batch(grids, max_solutions=None, block_size=10000):
+    """Generate a list of solutions for each grid using NumPy.
+
+    Grids are loaded block_size at a time into an array of candidate
+    bitmasks and propagated together, so grids that need no search are
+    solved without any per-grid Python work. Only the grids left
+    unresolved are searched one at a time. Results are the same as for
+    solve_many(): None for a grid that is not a proper text
+    representation, otherwise a list of at most max_solutions solutions."""
+    try:
+        _np_tables()
+    except ImportError:
+        raise ImportError('solve_batch() requires NumPy.')
+    grids = iter(grids)
+    while True:
+        block = list(itertools.islice(grids, block_size))
+        if not block:
+            return
+        for solutions in _np_solve_block(block, max_solutions):
+            yield solutions
+
+
+def solve_many(grids, workers=None, chunksize=64, max_solutions=None,
+               engine='bitmask'):
+    """Generate a list of solutions for each grid, in the order given.
+
+    The grids are sent to a pool of worker processes (one per CPU unless
+    workers says otherwise) in chunks of chunksize grids. At most
+    max_solutions solutions are found for each grid. A grid that is not a
+    proper text representation gives None rather than stopping the batch.
+    With workers=1 everything is solved in this process. Grids can also
+    be packed records, such as those of a PackedGrids file."""
+    _check_engine(engine)
+    solve_one = functools.partial(_solve_one, max_solutions=max_solutions,
+                                  engine=engine)
+    for n, solutions in _pool_map(solve_one, grids, workers, chunksize):
+        yield solutions
+
+
+def solve_parallel(grid, max_solutions=1, workers=None, pool=None):
+    """Return a list of up to max_solutions solutions for grid.
+
+    For a single hard grid: the search tree is split at its first few
+    branching squares, picked as the bitmask engine picks them, into about
+    four subtrees per worker process (one per CPU unless workers says
+    otherwise). As soon as max_solutions are found, the other workers are
+    stopped, so by default the first solution found wins. With
+    max_solutions=None, every solution is found, in the order solve()
+    would generate them.
+
+    Starting worker processes takes longer than most searches, so they are
+    kept for the next call: pass a SearchPool as pool, or one shared by all
+    callers with the same number of workers is used. With workers=1 the
+    search runs in this process."""
+    results = _parallel_search(grid, max_solutions, workers, False, pool)
+    solutions = [solution for result in results if result is not None
+                 for solution in result]
+    return solutions[:max_solutions]
+
+
+def unpack_grid(record):
+    """Return the 81 character grid string for a packed record."""
+    return _packed_values(record).translate(_UNPACK_CHARS).decode('ascii')
+
+
+def write_packed(path, grids, solutions=None):
+    """Write grids to path in the packed format, and return how many.
+
+    Grids can be text or packed records. If solutions is given, it holds
+    the solution for each grid, which is written after it. The file is
+    written under a temporary name and only renamed to path once complete,
+    so an error leaves path as it was."""
+    flags = 0 if solutions is None else 1
+    if solutions is None:
+        pairs = ((grid, None) for grid in grids)
+    else:
+        pairs = itertools.zip_longest(grids, solutions)
+    count = 0
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(PACKED_MAGIC + bytes([PACKED_VERSION, flags, 0, 0]))
+            for grid, solution in pairs:
+                if grid is None or flags and solution is None:
+                    raise ValueError('Need one solution for each grid.')
+                f.write(pack_grid(grid))
+                if flags:
+                    f.write(pack_grid(solution))
+                count += 1
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+    return count
+
+
 #==============================================================================
 # Private API
 #==============================================================================
@@ -175,249 +733,2677 @@ def _assign(grid_map, i, digit):
         return False
 
 
-def _eliminate(grid_map, i, digit):
-    """Eliminate digit from possible digits for square at grid_map[i]."""
-    possible_digits = grid_map[i]
-    if digit not in possible_digits:
-        return grid_map
-    possible_digits = possible_digits.replace(digit, '')
-    grid_map[i] = possible_digits
-    if len(possible_digits) == 0:
+def _async_runner():
+    """Return the AsyncRunner used when none is given."""
+    if not _ASYNC_RUNNER:
+        _ASYNC_RUNNER.append(AsyncRunner())
+    return _ASYNC_RUNNER[0]
+
+
+async def _async_wait(job, timeout):
+    """Await job, cancelling it after timeout seconds if not None."""
+    import asyncio
+    if timeout is None:
+        return await job
+    return await asyncio.wait_for(job, timeout)
+
+
+def _band_keys(line_keys):
+    """Return the key of each band of three lines, given their keys."""
+    return [sorted(line_keys[b:b + 3]) for b in range(0, 9, 3)]
+
+
+def _bits_assign(board, i, bit, trail):
+    """Assign the digit for bit to board[i] and eliminate from peers."""
+    others = board[i] & ~bit
+    while others:
+        other = others & -others
+        if not _bits_eliminate(board, i, other, trail):
+            return False
+        others ^= other
+    return board
+
+
+def _bits_count(board, trail, limit=None, found=None, stats=None, depth=1,
+                strategies=(), search_limit=None):
+    """Return number of solved versions of board, counting up to limit.
+
+    Searches like _bits_solve, but without yielding. If found is a list,
+    a copy of the first solved board is appended to it. A _SearchLimit
+    passed as search_limit is checked at each node, as for _bits_solve."""
+    if search_limit is not None:
+        search_limit.check()
+    if stats is not None:
+        stats.nodes += 1
+        stats.max_depth = max(stats.max_depth, depth)
+    start = len(trail)
+    if strategies and not _bits_deduce(board, trail, strategies, stats):
+        _bits_undo(board, trail, start)
+        return 0
+    next_i = None
+    fewest = 10
+    for i in range(81):
+        count = MASK_COUNTS[board[i]]
+        if 1 < count < fewest:
+            next_i = i
+            fewest = count
+            if count == 2:
+                break
+    if next_i is None:
+        if found is not None and not found:
+            found.append(board[:81])
+        _bits_undo(board, trail, start)
+        return 1
+    total = 0
+    mask = board[next_i]
+    mark = len(trail)
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        if _bits_assign(board, next_i, bit, trail):
+            total += _bits_count(board, trail, limit and limit - total,
+                                 found, stats, depth + 1, strategies,
+                                 search_limit)
+        elif stats is not None:
+            stats.contradictions += 1
+        if stats is not None:
+            stats._count_trail(board, trail, mark)
+            stats.backtracks += 1
+        _bits_undo(board, trail, mark)
+        if limit and total >= limit:
+            break
+    _bits_undo(board, trail, start)
+    return total
+
+
+def _bits_dug_grid(min_assigned_squares, symmetrical, strategies=(),
+                   limit=None):
+    """Return a random (grid, solution) pair made by digging holes.
+
+    Digging counts as a single attempt against limit."""
+    min_assigned_squares = max(min_assigned_squares, 17)
+    min_assigned_squares = min(min_assigned_squares, 80)
+    if limit is not None:
+        limit.check_attempt()
+    board = [ALL_DIGITS_MASK] * (81 + 27 * 9)
+    _bits_random_fill(board, [])
+    solution = _bits_to_grid(board)
+    clues = list(solution)
+    assigned = 81
+    for i in _shuffled(range(81)):
+        if clues[i] == '.':
+            # Already removed earlier as a mirror for symmetry.
+            continue
+        holes = sorted({i, 80 - i}) if symmetrical else [i]
+        if assigned - len(holes) < min_assigned_squares:
+            continue
+        if limit is not None:
+            limit.check_time()
+        for hole in holes:
+            clues[hole] = '.'
+        if _bits_still_unique(clues, solution, holes, strategies, limit):
+            assigned -= len(holes)
+        else:
+            for hole in holes:
+                clues[hole] = solution[hole]
+    return ''.join(clues), solution
+
+
+def _bits_deduce(board, trail, strategies, stats=None):
+    """Apply (name, function) strategies to board until none eliminate any
+    more digits, going back to the first after any elimination.
+
+    Return False if a strategy runs into a contradiction."""
+    k = 0
+    while k < len(strategies):
+        name, deduce = strategies[k]
+        eliminated = deduce(board, trail)
+        if eliminated is None:
+            if stats is not None:
+                stats.contradictions += 1
+            return False
+        elif eliminated:
+            if stats is not None:
+                stats.strategy_hits[name] += eliminated
+            k = 0
+        else:
+            k += 1
+    return True
+
+
+def _bits_eliminate(board, i, bit, trail):
+    """Eliminate the digit for bit from possible digits for board[i].
+
+    The square's previous mask is pushed onto trail so _bits_undo can put
+    it back."""
+    mask = board[i]
+    if not mask & bit:
+        return board
+    trail.append((i, mask))
+    mask ^= bit
+    board[i] = mask
+    if not mask:
         # We just eliminated the only possible digit for the square.
-        # That means we don't have a well-formed grid.
         return False
-    elif len(possible_digits) == 1:
-        # This square is now the only square that can have this digit
-        # so eliminate this digit from all of the square's peers.
-        if not all(_eliminate(grid_map, peer, possible_digits)
-                   for peer in PEERS[i]):
-            return False
-    for unit in UNITS[i]:
+    n = BIT_INDEX[bit]
+    slots = SLOTS[i]
+    for u, base, position in slots:
+        board[base + n] &= ~position
+    if MASK_COUNTS[mask] == 1:
+        # Eliminate the square's only possible digit from all its peers.
+        for peer in PEER_LISTS[i]:
+            if (board[peer] & mask and
+                    not _bits_eliminate(board, peer, mask, trail)):
+                return False
+    for u, base, position in slots:
         # Check each of the square's units to see if there is now
         # only one place where this digit can be assigned and do it.
-        places = [i2 for i2 in unit if digit in grid_map[i2]]
-        if len(places) == 0:
+        places = board[base + n]
+        if not places:
             return False
-        elif len(places) == 1:
-            if not _assign(grid_map, places[0], digit):
+        elif MASK_COUNTS[places] == 1:
+            other_i = UNIT_SQUARES[u][BIT_INDEX[places]]
+            if (board[other_i] != bit and
+                    not _bits_assign(board, other_i, bit, trail)):
                 return False
-    return grid_map
-
+    return board
 
-def _grid_map_all_digits():
-    """Return dictionary of {i: string_of_all_digits} pairs."""
-    string_of_all_digits = ''.join(DIGITS)
-    return {i: string_of_all_digits for i in range(81)}
 
+def _bits_propagated(grid, stats=None):
+    """Return bitmask board for grid, or False if it cannot be solved.
 
-def _grid_map_propogated(grid):
-    """Return dictionary of {i: possible_digits} pairs."""
-    grid_map = _grid_map_all_digits()
+    Grid can also be the square values from _packed_values()."""
+    board = [ALL_DIGITS_MASK] * (81 + 27 * 9)
+    trail = []
     for i, digit in enumerate(grid):
-        if digit in DIGITS and not _assign(grid_map, i, digit):
+        bit = _VALUE_MASKS.get(digit)
+        if bit and not _bits_assign(board, i, bit, trail):
+            if stats is not None:
+                stats._count_trail(board, trail, 0)
+                stats.contradictions += 1
             return False
-    return grid_map
+    if stats is not None:
+        stats._count_trail(board, trail, 0)
+    return board
 
 
-def _random_grid(min_assigned_squares, symmetrical):
-    """Return a random (grid, solution) pair, or False if failed."""
+def _bits_random_grid(min_assigned_squares, symmetrical, stats=None,
+                      strategies=(), limit=None):
+    """Return a random (grid, solution) pair, or False if failed.
+
+    Makes the same random choices as _random_grid, so both engines return
+    the same pair for the same random seed. The uniqueness check is
+    stopped by limit as any other search."""
     min_assigned_squares = max(min_assigned_squares, 17)
     min_assigned_squares = min(min_assigned_squares, 80)
     min_unique_digits = 8
-    grid_map = _grid_map_all_digits()
+    board = [ALL_DIGITS_MASK] * (81 + 27 * 9)
+    trail = []
     mirror = list(reversed(range(81)))
     assigned_squares = []
+    result = False
     for i in _shuffled(range(81)):
         if i in assigned_squares:
             # Already assigned earlier as a mirror for symmetry.
             continue
-        if not _assign(grid_map, i, random.choice(grid_map[i])):
+        digit = random.choice(MASK_DIGITS[board[i]])
+        if not _bits_assign(board, i, DIGIT_MASKS[digit], trail):
             break
         assigned_squares.append(i)
         if symmetrical:
             # Assign a value to the mirror square as well.
             other_i = mirror[i]
             if other_i != i:
-                if not _assign(grid_map, other_i,
-                               random.choice(grid_map[other_i])):
+                digit = random.choice(MASK_DIGITS[board[other_i]])
+                if not _bits_assign(board, other_i, DIGIT_MASKS[digit],
+                                    trail):
                     break
                 assigned_squares.append(other_i)
-        unique_digits = {grid_map[i] for i in assigned_squares}
+        unique_digits = {board[i] for i in assigned_squares}
         if (len(assigned_squares) >= min_assigned_squares and
                 len(unique_digits) >= min_unique_digits):
             # Sudoku requires a grid with one and only one solution.
-            count = 0
-            for solved_grid_map in _solve(grid_map):
-                count += 1
-                if count > 1:
-                    break
-            if not count == 1:
-                # No solution or more than one solution.
+            # The search undoes its own changes, so board is left as is.
+            found = []
+            if _bits_count(board, trail, 2, found, stats,
+                           strategies=strategies, search_limit=limit) == 1:
+                unassigned_squares = set(range(81)) - set(assigned_squares)
+                grid = _bits_to_grid(board, unassigned_squares)
+                result = grid, _bits_to_grid(found[0])
+            # Otherwise there was no solution or more than one solution.
+            break
+    if stats is not None:
+        stats.attempts += 1
+        stats._count_trail(board, trail, 0)
+        if not result:
+            stats.failed_attempts += 1
+    return result
+
+
+def _bits_random_fill(board, trail):
+    """Assign random digits to every square of board, backtracking as needed.
+
+    Return False if board has no solution."""
+    next_i = None
+    fewest = 10
+    for i in range(81):
+        count = MASK_COUNTS[board[i]]
+        if 1 < count < fewest:
+            next_i = i
+            fewest = count
+            if count == 2:
                 break
-            unassigned_squares = set(range(81)) - set(assigned_squares)
-            grid = _to_grid(grid_map, unassigned_squares)
-            solution = _to_grid(solved_grid_map)
-            return grid, solution
-    # Failed to setup a single-solution grid.
+    if next_i is None:
+        return True
+    mark = len(trail)
+    for digit in _shuffled(MASK_DIGITS[board[next_i]]):
+        if (_bits_assign(board, next_i, DIGIT_MASKS[digit], trail) and
+                _bits_random_fill(board, trail)):
+            return True
+        _bits_undo(board, trail, mark)
     return False
 
 
-def _shuffled(iterable):
-    """Return shuffled copy of iterable as a list."""
-    l = list(iterable)
-    random.shuffle(l)
-    return l
-
+def _bits_solve(board, trail=None, stats=None, depth=1, strategies=(),
+                limit=None):
+    """Generate all possible solved versions of board using brute force.
 
-def _solve(grid_map):
-    """Generate all possible solved versions of grid_map using brute force."""
-    if not grid_map:
-        return
-    if all(len(grid_map[i]) == 1 for i in range(81)):
-        yield grid_map
+    Rather than copying the board for every branch, the search assigns in
+    place and backtracks by undoing the trail. Each solved board is the
+    live board, so use it before asking for the next one. The board is
+    back as it was once the generator is exhausted or closed. Any
+    strategies are run to a fixed point before each branch. A _SearchLimit
+    as limit is checked at each node."""
+    if not board:
         return
-    next_i = min((len(grid_map[i]), i) for i in range(81)
-                 if len(grid_map[i]) > 1)[1]
-    possible_digits = grid_map[next_i]
-    for digit in possible_digits:
-        for solved_grid_map in _solve(_assign(grid_map.copy(), next_i, digit)):
-            yield solved_grid_map
+    if limit is not None:
+        limit.check()
+    if trail is None:
+        trail = []
+    if stats is not None:
+        stats.nodes += 1
+        stats.max_depth = max(stats.max_depth, depth)
+    start = len(trail)
+    try:
+        if strategies and not _bits_deduce(board, trail, strategies, stats):
+            return
+        next_i = None
+        fewest = 10
+        for i in range(81):
+            count = MASK_COUNTS[board[i]]
+            if 1 < count < fewest:
+                next_i = i
+                fewest = count
+                if count == 2:
+                    break
+        if next_i is None:
+            yield board
+            return
+        mask = board[next_i]
+        mark = len(trail)
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            if _bits_assign(board, next_i, bit, trail):
+                for solved_board in _bits_solve(board, trail, stats,
+                                                depth + 1, strategies,
+                                                limit):
+                    yield solved_board
+            elif stats is not None:
+                stats.contradictions += 1
+            if stats is not None:
+                stats._count_trail(board, trail, mark)
+                stats.backtracks += 1
+            _bits_undo(board, trail, mark)
+    finally:
+        _bits_undo(board, trail, start)
 
 
-def _to_grid(grid_map, unassigned_squares=[]):
-    """Return grid string for a grid_map dictionary.
+def _bits_split(board, wanted):
+    """Return the boards branching from board, in the order searched.
+
+    Branch on the square with the fewest possible digits, as _bits_solve
+    does, level after level until there are at least wanted boards or none
+    left to branch."""
+    boards = [board]
+    while len(boards) < wanted:
+        branched = []
+        for board in boards:
+            next_i = None
+            fewest = 10
+            for i in range(81):
+                count = MASK_COUNTS[board[i]]
+                if 1 < count < fewest:
+                    next_i = i
+                    fewest = count
+                    if count == 2:
+                        break
+            if next_i is None:
+                branched.append(board)
+                continue
+            mask = board[next_i]
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                child = board[:]
+                if _bits_assign(child, next_i, bit, []):
+                    branched.append(child)
+        if len(branched) == len(boards):
+            # Every board is solved, so there is nothing left to split.
+            return branched
+        boards = branched
+    return boards
+
+
+def _bits_still_unique(clues, solution, holes, strategies=(), limit=None):
+    """Return True if solution is still the only solution once holes are dug.
+
+    Rather than counting solutions, look for one that differs from solution
+    at one of the new holes, which is all that removing them could allow."""
+    board = _bits_propagated(''.join(clues))
+    trail = []
+    for hole in holes:
+        bit = DIGIT_MASKS[solution[hole]]
+        mark = len(trail)
+        if (_bits_eliminate(board, hole, bit, trail) and
+                _bits_count(board, trail, 1, strategies=strategies,
+                            search_limit=limit)):
+            return False
+        _bits_undo(board, trail, mark)
+        # Any other solution must differ at a later hole instead.
+        _bits_assign(board, hole, bit, trail)
+    return True
+
+
+def _bits_to_grid(board, unassigned_squares=()):
+    """Return grid string for a bitmask board.
 
     Use a dot for an unassigned square, rather than its propogated value."""
-    return ''.join(grid_map[i]
-                   if len(grid_map[i]) == 1
+    return ''.join(MASK_DIGITS[board[i]]
+                   if MASK_COUNTS[board[i]] == 1
                    and i not in unassigned_squares else '.'
                    for i in range(81))
 
 
-#==============================================================================
-# And now for something completely different: Python Classes
-#==============================================================================
+def _bits_undo(board, trail, mark):
+    """Pop trail back down to mark, restoring each square's previous mask."""
+    while len(trail) > mark:
+        i, mask = trail.pop()
+        n = BIT_INDEX[mask ^ board[i]]
+        board[i] = mask
+        for u, base, position in SLOTS[i]:
+            board[base + n] |= position
 
 
-class Puzzle(object):
-    """Puzzle class."""
+def _check_grid(grid):
+    """Return solution for grid, or 'invalid', 'unsolvable' or 'multiple'."""
+    try:
+        grid = normalize(grid)
+    except ValueError:
+        return 'invalid'
+    if not is_valid(grid):
+        return 'invalid'
+    board = _bits_propagated(grid)
+    found = []
+    count = _bits_count(board, [], 2, found) if board else 0
+    if count == 0:
+        return 'unsolvable'
+    elif count > 1:
+        return 'multiple'
+    return _bits_to_grid(found[0])
 
-    def __init__(self):
-        """Create a Puzzle instance."""
-        self.boxes = []
-        self.columns = []
-        self.rows = []
-        self.squares = []
-        self.mirror = {}
-        self.box_finder = {}
-        self._setup()
-
-    def _setup(self):
-        """Setup all the puzzle pieces."""
-        sizer = range(9)
-        triples = [sizer[0:3], sizer[3:6], sizer[6:9]]
-        boxing = [(rs, cs) for rs in triples for cs in triples]
-        for nb, (rs, cs) in enumerate(boxing):
-            self.box_finder.update({(nr, nc): nb for nr in rs for nc in cs})
-        for n in sizer:
-            num = n + 1
-            self.rows.append(Row(num))
-            self.columns.append(Column(num))
-            self.boxes.append(Box(num))
-        num = 0
-        for nr in sizer:
-            row = self.rows[nr]
-            for nc in sizer:
-                column = self.columns[nc]
-                box = self.boxes[self.box_finder[(nr, nc)]]
-                num += 1
-                self.squares.append(Square(num, self, row, column, box))
-        self.mirror = dict(zip(self.squares, reversed(self.squares)))
-        for square in self.squares:
-            square._setup_peers()
 
-    @property
-    def assigned_digits(self):
-        """Return set of digits that have been successfully assigned."""
-        return {square.current_value for square in self.squares
-                if square.was_assigned}
+def _check_numbered_grid(numbered_grid):
+    """Return (n, _check_grid(grid)) for an (n, grid) pair, or (n, '').
 
-    @property
-    def assigned_squares(self):
-        """Return list of squares with assigned values."""
-        return [square for square in self.squares if square.was_assigned]
+    A blank grid gives an empty result."""
+    n, grid = numbered_grid
+    return n, _check_grid(grid) if grid.strip() else ''
 
-    @property
-    def assigned_grid(self):
-        """Return the assigned grid as an 81 character string."""
-        return ''.join(square.current_value
-                       if square.current_value and square.was_assigned else '.'
-                       for square in self.squares)
 
-    @property
-    def current_grid(self):
-        """Return the current grid as an 81 character string."""
-        return ''.join(square.current_value
-                       if square.current_value else '.'
-                       for square in self.squares)
+def _check_stats(engine, stats):
+    """Raise ValueError if stats are asked of an engine without them."""
+    if stats is not None and engine != 'bitmask':
+        raise ValueError('Search stats need the bitmask engine.')
 
-    @property
-    def solved_grid(self):
-        """Return the solved grid as an 81 character string."""
-        return ''.join(square.solved_value
-                       if square.solved_value else '.'
-                       for square in self.squares)
 
-    @property
-    def is_solved(self):
-        """Return True if all squares have been solved."""
-        return all(square.is_solved for square in self.squares)
+def _check_strategies(engine, strategies):
+    """Return tuple of (name, function) pairs for strategies.
 
-    def reset(self):
-        """Reset the puzzle back to a clean slate."""
-        for square in self.squares:
-            square._reset()
+    Raise ValueError for an unknown strategy, or an engine without them."""
+    if not strategies:
+        return ()
+    if engine != 'bitmask':
+        raise ValueError('Strategies need the bitmask engine.')
+    if strategies == 'all':
+        strategies = STRATEGIES
+    functions = {
+        'naked_pairs': _deduce_naked_pairs,
+        'hidden_pairs': _deduce_hidden_pairs,
+        'pointing': _deduce_pointing,
+        'box_line': _deduce_box_line,
+        'naked_triples': _deduce_naked_triples,
+        'hidden_triples': _deduce_hidden_triples,
+        'x_wing': _deduce_x_wing,
+    }
+    unknown = set(strategies) - set(functions)
+    if unknown:
+        raise ValueError('Unknown strategies %s, expected some of %s.'
+                         % (', '.join(sorted(unknown)), ', '.join(STRATEGIES)))
+    # Cheaper strategies first, since _bits_deduce keeps starting over.
+    return tuple((name, functions[name]) for name in STRATEGIES
+                 if name in strategies)
 
-    def setup_random_grid(self, min_assigned_squares=40, symmetrical=True):
-        """Setup random grid with a min of 26 to a max of 80 squares assigned.
 
-        Processing less than 26 assigned squares can take a long time."""
-        self.reset()
-        min_assigned_squares = max(min_assigned_squares, 26)
-        grid, solution = random_grid(min_assigned_squares, symmetrical)
-        for i, square in enumerate(self.squares):
-            square.solved_value = solution[i]
-            if grid[i] != '.':
-                square._assign(grid[i])
+def _check_size(size, engine='bitmask', stats=None, strategies=None):
+    """Raise ValueError for a size not in SIZES.
 
+    Sizes other than 9 also need the bitmask engine, without stats or
+    strategies."""
+    if size not in SIZES:
+        raise ValueError('Unknown size %r, expected one of %s.'
+                         % (size, ', '.join(str(s) for s in SIZES)))
+    if size != 9 and (engine != 'bitmask' or stats is not None or
+                      strategies):
+        raise ValueError('A %dx%d grid needs the bitmask engine, without '
+                         'stats or strategies.' % (size, size))
 
-class Unit(object):
-    """Parent class for Row, Column and Box."""
 
-    def __init__(self, number):
-        self.number = number
-        self.name = str(number)
-        self.squares = []
+def _check_engine(engine):
+    """Raise ValueError if engine is not one of ENGINES."""
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine %r, expected one of %s.'
+                         % (engine, ', '.join(sorted(ENGINES))))
 
-    def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, self.number)
 
+def _deduce_box_line(board, trail, eliminate=_bits_eliminate):
+    """Eliminate digits by box/line reduction.
 
-class Row(Unit):
-    pass
+    If a digit's places in a row or column all lie in one box, the digit
+    cannot go anywhere else in that box."""
+    return _deduce_intersections(board, trail, range(18), (2,), eliminate)
 
 
-class Column(Unit):
-    pass
+def _deduce_eliminate(board, trail, i, mask, eliminate=_bits_eliminate):
+    """Eliminate each digit of mask from board[i].
 
+    Return the number of digits eliminated, or None on a contradiction."""
+    mask &= board[i]
+    eliminated = 0
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        if board[i] & bit:
+            if not eliminate(board, i, bit, trail):
+                return None
+            eliminated += 1
+    return eliminated
 
-class Box(Unit):
-    pass
+
+def _deduce_hidden_pairs(board, trail, eliminate=_bits_eliminate):
+    """Eliminate other digits from squares holding a hidden pair."""
+    return _deduce_hidden_subsets(board, trail, 2, eliminate)
+
+
+def _deduce_hidden_subsets(board, trail, size, eliminate=_bits_eliminate):
+    """Eliminate digits using hidden subsets of size digits.
+
+    If size digits can only go in the same size squares of a unit, those
+    squares cannot hold any other digit."""
+    eliminated = 0
+    for u, unit in enumerate(UNIT_SQUARES):
+        base = 81 + 9 * u
+        digits = [n for n in range(9)
+                  if 1 < MASK_COUNTS[board[base + n]] <= size]
+        for subset in itertools.combinations(digits, size):
+            places = 0
+            digits_mask = 0
+            for n in subset:
+                places |= board[base + n]
+                digits_mask |= 1 << n
+            if MASK_COUNTS[places] != size:
+                continue
+            for p in range(9):
+                if places & (1 << p):
+                    count = _deduce_eliminate(
+                        board, trail, unit[p], ~digits_mask & ALL_DIGITS_MASK,
+                        eliminate)
+                    if count is None:
+                        return None
+                    eliminated += count
+    return eliminated
+
+
+def _deduce_hidden_triples(board, trail, eliminate=_bits_eliminate):
+    """Eliminate other digits from squares holding a hidden triple."""
+    return _deduce_hidden_subsets(board, trail, 3, eliminate)
+
+
+def _deduce_intersections(board, trail, units, kinds,
+                          eliminate=_bits_eliminate):
+    """Eliminate digits whose places in one of units all lie in one other
+    unit, of one of kinds (0 for row, 1 for column, 2 for box), from the
+    rest of that other unit."""
+    eliminated = 0
+    for u in units:
+        base = 81 + 9 * u
+        unit = UNIT_SQUARES[u]
+        for n in range(9):
+            places = board[base + n]
+            if MASK_COUNTS[places] < 2:
+                continue
+            squares = [unit[p] for p in range(9) if places & (1 << p)]
+            for kind in kinds:
+                other_u = SLOTS[squares[0]][kind][0]
+                if any(SLOTS[i][kind][0] != other_u for i in squares[1:]):
+                    continue
+                for i in UNIT_SQUARES[other_u]:
+                    if i not in squares and board[i] & (1 << n):
+                        count = _deduce_eliminate(board, trail, i, 1 << n,
+                                                  eliminate)
+                        if count is None:
+                            return None
+                        eliminated += count
+    return eliminated
+
+
+def _deduce_naked_pairs(board, trail, eliminate=_bits_eliminate):
+    """Eliminate the digits of naked pairs from the rest of their units."""
+    return _deduce_naked_subsets(board, trail, 2, eliminate)
+
+
+def _deduce_naked_subsets(board, trail, size, eliminate=_bits_eliminate):
+    """Eliminate digits using naked subsets of size squares.
+
+    If size squares of a unit can only hold the same size digits between
+    them, no other square of the unit can hold those digits."""
+    eliminated = 0
+    for unit in UNIT_SQUARES:
+        squares = [i for i in unit if 1 < MASK_COUNTS[board[i]] <= size]
+        for subset in itertools.combinations(squares, size):
+            digits_mask = 0
+            for i in subset:
+                digits_mask |= board[i]
+            if MASK_COUNTS[digits_mask] != size:
+                continue
+            for i in unit:
+                if i not in subset and board[i] & digits_mask:
+                    count = _deduce_eliminate(board, trail, i, digits_mask,
+                                              eliminate)
+                    if count is None:
+                        return None
+                    eliminated += count
+    return eliminated
+
+
+def _deduce_naked_triples(board, trail, eliminate=_bits_eliminate):
+    """Eliminate the digits of naked triples from the rest of their units."""
+    return _deduce_naked_subsets(board, trail, 3, eliminate)
+
+
+def _deduce_pointing(board, trail, eliminate=_bits_eliminate):
+    """Eliminate digits using pointing pairs and triples.
+
+    If a digit's places in a box all lie in one row or column, the digit
+    cannot go anywhere else in that row or column."""
+    return _deduce_intersections(board, trail, range(18, 27), (0, 1),
+                                 eliminate)
+
+
+def _deduce_x_wing(board, trail, eliminate=_bits_eliminate):
+    """Eliminate digits using X-wings.
+
+    If a digit has the same two places in two rows, it must go in those
+    two columns in those rows, so nowhere else in the columns; and the
+    same the other way around."""
+    eliminated = 0
+    for n in range(9):
+        bit = 1 << n
+        for lines, crossing in ((range(9), 9), (range(9, 18), 0)):
+            pairs = collections.defaultdict(list)
+            for u in lines:
+                places = board[81 + 9 * u + n]
+                if MASK_COUNTS[places] == 2:
+                    pairs[places].append(u - lines[0])
+            for places, wing in pairs.items():
+                if len(wing) != 2:
+                    continue
+                for p in range(9):
+                    if not places & (1 << p):
+                        continue
+                    cross = UNIT_SQUARES[crossing + p]
+                    for q in range(9):
+                        if q not in wing and board[cross[q]] & bit:
+                            count = _deduce_eliminate(board, trail, cross[q],
+                                                      bit, eliminate)
+                            if count is None:
+                                return None
+                            eliminated += count
+    return eliminated
+
+
+def _dlx_choose(links, grid):
+    """Choose the rows for grid's assigned squares, covering their columns.
+
+    Return False if two of them need the same column."""
+    left, right, up, down, column, size = links
+    for i, digit in enumerate(grid):
+        if digit in DIGITS:
+            row = 325 + 4 * (9 * i + int(digit) - 1)
+            for c in column[row:row + 4]:
+                if right[left[c]] != c:
+                    return False
+                _dlx_cover(links, c)
+    return links
+
+
+def _dlx_cover(links, c):
+    """Unlink column c, and every row with a node in it, from links."""
+    left, right, up, down, column, size = links
+    right[left[c]] = right[c]
+    left[right[c]] = left[c]
+    i = down[c]
+    while i != c:
+        j = right[i]
+        while j != i:
+            down[up[j]] = down[j]
+            up[down[j]] = up[j]
+            size[column[j]] -= 1
+            j = right[j]
+        i = down[i]
+
+
+def _dlx_links():
+    """Return [left, right, up, down, column, size] lists for an empty grid.
+
+    The exact cover matrix has a column for each of the 324 constraints (a
+    digit in each square, and each digit once in each row, column and box)
+    and a row for each of the 729 (square, digit) choices. Node 0 is the
+    root, node c + 1 heads column c, which is numbered like the bitmask
+    board, and row 9 * i + n is the four nodes from 325 + 4 * (9 * i + n).
+    The lists are copied from a template built the first time."""
+    if not _DLX_TEMPLATE:
+        left = [324] + list(range(324))
+        right = list(range(1, 325)) + [0]
+        up = list(range(325))
+        down = list(range(325))
+        column = list(range(325))
+        size = [0] * 325
+        for i in range(81):
+            for n in range(9):
+                first = len(column)
+                columns = [1 + i] + [1 + base + n for u, base, bit in SLOTS[i]]
+                for k, c in enumerate(columns):
+                    x = first + k
+                    left.append(first + (k - 1) % 4)
+                    right.append(first + (k + 1) % 4)
+                    up.append(up[c])
+                    down.append(c)
+                    column.append(c)
+                    size[c] += 1
+                    down[up[c]] = x
+                    up[c] = x
+        # Assigned in one step, so threads building it at the same time
+        # can't both add to it.
+        _DLX_TEMPLATE[:] = [left, right, up, down, column, size]
+    return [list(links) for links in _DLX_TEMPLATE]
+
+
+def _dlx_solve(links, chosen, limit=None):
+    """Generate chosen, the list of rows chosen, for each exact cover.
+
+    Knuth's Algorithm X: branch on the column with the fewest rows left,
+    trying each of its rows in turn. The links are restored between
+    solutions, but not if the generator is closed early."""
+    if limit is not None:
+        limit.check()
+    left, right, up, down, column, size = links
+    c = right[0]
+    if not c:
+        yield chosen
+        return
+    fewest = size[c]
+    j = right[c]
+    while j and fewest > 1:
+        if size[j] < fewest:
+            c = j
+            fewest = size[j]
+        j = right[j]
+    if not fewest:
+        return
+    _dlx_cover(links, c)
+    i = down[c]
+    while i != c:
+        chosen.append((i - 325) // 4)
+        j = right[i]
+        while j != i:
+            _dlx_cover(links, column[j])
+            j = right[j]
+        for solution in _dlx_solve(links, chosen, limit):
+            yield solution
+        j = left[i]
+        while j != i:
+            _dlx_uncover(links, column[j])
+            j = left[j]
+        chosen.pop()
+        i = down[i]
+    _dlx_uncover(links, c)
+
+
+def _dlx_to_grid(grid, chosen):
+    """Return grid string for grid with the rows in chosen filled in."""
+    squares = list(grid)
+    for row in chosen:
+        squares[row // 9] = str(row % 9 + 1)
+    return ''.join(squares)
+
+
+def _dlx_uncover(links, c):
+    """Relink column c, and its rows, undoing _dlx_cover(links, c)."""
+    left, right, up, down, column, size = links
+    i = up[c]
+    while i != c:
+        j = left[i]
+        while j != i:
+            size[column[j]] += 1
+            down[up[j]] = j
+            up[down[j]] = j
+            j = left[j]
+        i = up[i]
+    right[left[c]] = c
+    left[right[c]] = c
+
+
+def _eliminate(grid_map, i, digit):
+    """Eliminate digit from possible digits for square at grid_map[i]."""
+    possible_digits = grid_map[i]
+    if digit not in possible_digits:
+        return grid_map
+    possible_digits = possible_digits.replace(digit, '')
+    grid_map[i] = possible_digits
+    if len(possible_digits) == 0:
+        # We just eliminated the only possible digit for the square.
+        # That means we don't have a well-formed grid.
+        return False
+    elif len(possible_digits) == 1:
+        # This square is now the only square that can have this digit
+        # so eliminate this digit from all of the square's peers.
+        if not all(_eliminate(grid_map, peer, possible_digits)
+                   for peer in PEERS[i]):
+            return False
+    for unit in UNITS[i]:
+        # Check each of the square's units to see if there is now
+        # only one place where this digit can be assigned and do it.
+        places = [i2 for i2 in unit if digit in grid_map[i2]]
+        if len(places) == 0:
+            return False
+        elif len(places) == 1:
+            if not _assign(grid_map, places[0], digit):
+                return False
+    return grid_map
+
+
+def _grid_map_all_digits():
+    """Return dictionary of {i: string_of_all_digits} pairs."""
+    string_of_all_digits = ''.join(sorted(DIGITS))
+    return {i: string_of_all_digits for i in range(81)}
+
+
+def _grid_map_propogated(grid, engine='bitmask'):
+    """Return dictionary of {i: possible_digits} pairs."""
+    _check_engine(engine)
+    if engine != 'norvig':
+        if engine == 'bitmask':
+            board = _bits_propagated(grid)
+        else:
+            board = _iter_propagated(grid)
+        if not board:
+            return False
+        return {i: MASK_DIGITS[board[i]] for i in range(81)}
+    grid_map = _grid_map_all_digits()
+    for i, digit in enumerate(grid):
+        if digit in DIGITS and not _assign(grid_map, i, digit):
+            return False
+    return grid_map
+
+
+def _np_propagate(cells):
+    """Propagate an (N, 81) array of candidate masks in place.
+
+    Applies the same two rules as _bits_eliminate to every grid at once
+    until nothing changes. Grids that hit a contradiction end up with all
+    of their squares set to 0."""
+    import numpy
+    tables = _np_tables()
+    counts = tables['counts']
+    peers = tables['peers']
+    units = tables['units']
+    square_units = tables['square_units']
+    while True:
+        before = cells.copy()
+        # Naked singles: remove each solved square's digit from its peers.
+        singles = numpy.where(counts[cells] == 1, cells, 0)
+        taken = numpy.zeros_like(cells)
+        for k in range(peers.shape[1]):
+            taken |= singles[:, peers[:, k]]
+        dead = (singles & taken).any(axis=1)
+        cells &= ~(taken & ~singles)
+        # Hidden singles: a digit with one place left in a unit goes there.
+        unit_cells = cells[:, units]
+        once = numpy.zeros(unit_cells.shape[:2], dtype=cells.dtype)
+        twice = numpy.zeros_like(once)
+        for p in range(units.shape[1]):
+            twice |= once & unit_cells[:, :, p]
+            once |= unit_cells[:, :, p]
+        dead |= (once != ALL_DIGITS_MASK).any(axis=1)
+        exactly_once = once & ~twice
+        hidden = numpy.zeros_like(cells)
+        for k in range(square_units.shape[1]):
+            hidden |= exactly_once[:, square_units[:, k]]
+        hidden &= cells
+        dead |= (counts[hidden] > 1).any(axis=1)
+        cells[:] = numpy.where(hidden != 0, hidden, cells)
+        dead |= (cells == 0).any(axis=1)
+        cells[dead] = 0
+        if numpy.array_equal(before, cells):
+            return cells
+
+
+def _np_solve_block(grids, max_solutions):
+    """Return list of solution lists for a block of grids.
+
+    Packed records have their nibbles split straight into an array of
+    square values, and text grids are translated to the same values."""
+    import numpy
+    tables = _np_tables()
+    results = [None] * len(grids)
+    values = numpy.zeros((len(grids), 81), dtype=numpy.uint8)
+    packed_rows = []
+    records = []
+    text_rows = []
+    texts = []
+    for n, grid in enumerate(grids):
+        if isinstance(grid, (bytes, bytearray, memoryview)):
+            if len(grid) == PACKED_GRID_BYTES:
+                packed_rows.append(n)
+                records.append(grid)
+            continue
+        try:
+            texts.append(normalize(grid))
+        except (TypeError, ValueError):
+            continue
+        text_rows.append(n)
+    if records:
+        packed = numpy.frombuffer(b''.join(records), dtype=numpy.uint8)
+        nibbles = numpy.empty((len(records), 2 * PACKED_GRID_BYTES),
+                              dtype=numpy.uint8)
+        nibbles[:, 0::2] = packed.reshape(-1, PACKED_GRID_BYTES) >> 4
+        nibbles[:, 1::2] = packed.reshape(-1, PACKED_GRID_BYTES) & 0x0f
+        values[packed_rows] = nibbles[:, :81]
+    if texts:
+        values[text_rows] = numpy.frombuffer(
+            ''.join(texts).encode('ascii').translate(_PACK_CHARS),
+            dtype=numpy.uint8).reshape(-1, 81)
+    # A record with a square over 9 is malformed.
+    proper = (values <= 9).all(axis=1)
+    rows = [n for n in sorted(packed_rows + text_rows) if proper[n]]
+    if not rows:
+        return results
+    cells = tables['value_masks'][values[rows]]
+    _np_propagate(cells)
+    counts = tables['counts'][cells]
+    solved = (counts == 1).all(axis=1)
+    dead = (counts == 0).any(axis=1)
+    digits = tables['mask_chars'][cells]
+    for k, n in enumerate(rows):
+        if max_solutions == 0 or dead[k]:
+            results[n] = []
+        elif solved[k]:
+            results[n] = [digits[k].tobytes().decode('ascii')]
+        else:
+            # Still unresolved, so hand what was propagated to the search.
+            board = _bits_propagated(
+                tables['mask_values'][cells[k]].tobytes())
+            solved_boards = _bits_solve(board) if board else ()
+            results[n] = [_bits_to_grid(solved_board) for solved_board in
+                          itertools.islice(solved_boards, max_solutions)]
+    return results
+
+
+def _np_tables():
+    """Return dictionary of NumPy lookup tables, built on first use."""
+    import numpy
+    _cache = _NP_TABLES
+    if not _cache:
+        value_masks = numpy.zeros(16, dtype=numpy.uint16)
+        value_masks[0] = ALL_DIGITS_MASK
+        mask_chars = numpy.full(512, ord('.'), dtype=numpy.uint8)
+        mask_values = numpy.zeros(512, dtype=numpy.uint8)
+        for digit, mask in DIGIT_MASKS.items():
+            value_masks[int(digit)] = mask
+            mask_chars[mask] = ord(digit)
+            mask_values[mask] = int(digit)
+        _cache.update(
+            value_masks=value_masks,
+            mask_chars=mask_chars,
+            mask_values=mask_values,
+            counts=numpy.array(MASK_COUNTS, dtype=numpy.uint8),
+            peers=numpy.array(PEER_LISTS, dtype=numpy.intp),
+            units=numpy.array(UNIT_SQUARES, dtype=numpy.intp),
+            square_units=numpy.array([[u for u, base, position in SLOTS[i]]
+                                      for i in range(81)], dtype=numpy.intp),
+        )
+    return _cache
+
+
+def _parallel_init(cancel):
+    """Keep the event that tells a worker process to stop searching."""
+    _PARALLEL_CANCEL[:] = [cancel]
+
+
+def _parallel_search(grid, wanted, workers, counting, pool=None):
+    """Return the results of _parallel_subtree for the subtrees of grid.
+
+    Subtrees are searched on pool (or the shared SearchPool for workers)
+    until wanted solutions have been found (or all subtrees searched). The
+    results are in search order, with None for the subtrees that were not
+    finished."""
+    grid = normalize(grid)
+    if wanted is not None and wanted < 1 or not is_valid(grid):
+        return []
+    board = _bits_propagated(grid)
+    if not board:
+        return []
+    if pool is None:
+        workers = workers or os.cpu_count() or 1
+    else:
+        workers = pool.workers
+    boards = _bits_split(board, 4 * workers)
+    if pool is None and workers > 1:
+        pool = _search_pool(workers)
+    if pool is not None:
+        return pool._search(boards, wanted, counting)
+    results = [None] * len(boards)
+    found = 0
+    for k, board in enumerate(boards):
+        results[k] = _parallel_subtree(board, wanted, counting)
+        found += results[k] if counting else len(results[k])
+        if wanted is not None and found >= wanted:
+            break
+    return results
+
+
+def _parallel_subtree(board, wanted, counting):
+    """Return up to wanted solutions in the subtree for board, or their
+    number if counting, or None if the search was stopped."""
+    limit = None
+    if _PARALLEL_CANCEL:
+        limit = _SearchLimit(cancel=_PARALLEL_CANCEL[0])
+    solved_boards = itertools.islice(_bits_solve(board, limit=limit),
+                                     wanted)
+    try:
+        if counting:
+            return sum(1 for solved_board in solved_boards)
+        return [_bits_to_grid(solved_board) for solved_board in solved_boards]
+    except SearchCancelled:
+        return None
+
+
+def _packed_values(record):
+    """Return bytes of the 81 square values of a packed record, 0 if
+    unassigned, which _bits_propagated takes in place of a grid string."""
+    if len(record) != PACKED_GRID_BYTES:
+        raise ValueError('Packed grid is not %d bytes.' % PACKED_GRID_BYTES)
+    packed = int.from_bytes(record, 'big')
+    values = bytearray(2 * PACKED_GRID_BYTES)
+    values[0::2] = (packed >> 4 & _LOW_NIBBLES).to_bytes(PACKED_GRID_BYTES,
+                                                         'big')
+    values[1::2] = (packed & _LOW_NIBBLES).to_bytes(PACKED_GRID_BYTES, 'big')
+    del values[81:]
+    if max(values) > 9:
+        raise ValueError('Packed grid has a square over 9.')
+    return bytes(values)
+
+
+def _pool_map(function, items, workers=None, chunksize=64, ordered=True):
+    """Generate (n, function(item)) pairs for each nth item of items.
+
+    Chunks of items are run on a pool of worker processes, with no more
+    than two chunks per worker in flight, so items can be an endless
+    stream. Pairs come in input order if ordered, else as chunks finish."""
+    import concurrent.futures
+    workers = workers or os.cpu_count() or 1
+    numbered = enumerate(items)
+    if workers == 1:
+        for n, item in numbered:
+            yield n, function(item)
+        return
+    chunks = iter(lambda: list(itertools.islice(numbered, chunksize)), [])
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        try:
+            for chunk in chunks:
+                numbers = [n for n, item in chunk]
+                # Views (of a PackedGrids file, say) can't be pickled.
+                future = executor.submit(
+                    _map_chunk, function,
+                    [bytes(item) if isinstance(item, memoryview) else item
+                     for n, item in chunk])
+                pending.append((numbers, future))
+                while len(pending) >= 2 * workers:
+                    for pair in _pool_map_drain(pending, ordered):
+                        yield pair
+            while pending:
+                for pair in _pool_map_drain(pending, ordered):
+                    yield pair
+        finally:
+            for numbers, future in pending:
+                future.cancel()
+
+
+def _pool_map_drain(pending, ordered):
+    """Remove a finished chunk from pending and return its pairs."""
+    import concurrent.futures
+    if ordered:
+        numbers, future = pending.popleft()
+    else:
+        futures = [future for numbers, future in pending]
+        concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        numbers, future = next(pair for pair in pending if pair[1].done())
+        pending.remove((numbers, future))
+    return zip(numbers, future.result())
+
+
+def _iter_assign(board, i, bit, trail):
+    """Assign the digit for bit to board[i] and propagate, without recursion.
+
+    Return False if that leads to a contradiction."""
+    others = board[i] & ~bit
+    queue = []
+    while others:
+        other = others & -others
+        queue.append((i, other))
+        others ^= other
+    return _iter_propagate(board, queue, trail)
+
+
+def _iter_propagate(board, queue, trail):
+    """Carry out the (i, bit) eliminations on queue, and all that follow.
+
+    The same rules as _bits_eliminate, but with further eliminations put
+    on the queue rather than made by recursive calls. Changes are pushed
+    onto trail as _bits_eliminate does. Return False on a contradiction."""
+    pop = queue.pop
+    push = queue.append
+    while queue:
+        i, bit = pop()
+        mask = board[i]
+        if not mask & bit:
+            continue
+        trail.append((i, mask))
+        mask ^= bit
+        board[i] = mask
+        if not mask:
+            return False
+        n = BIT_INDEX[bit]
+        for u, base, position in SLOTS[i]:
+            places = board[base + n] & ~position
+            board[base + n] = places
+            if not places:
+                return False
+            elif MASK_COUNTS[places] == 1:
+                # Only one place left in the unit for this digit.
+                other_i = UNIT_SQUARES[u][BIT_INDEX[places]]
+                others = board[other_i] & ~bit
+                while others:
+                    other = others & -others
+                    push((other_i, other))
+                    others ^= other
+        if MASK_COUNTS[mask] == 1:
+            for peer in PEER_LISTS[i]:
+                if board[peer] & mask:
+                    push((peer, mask))
+    return True
+
+
+def _iter_propagated(grid):
+    """Return bitmask board for grid, as _bits_propagated."""
+    board = [ALL_DIGITS_MASK] * (81 + 27 * 9)
+    trail = []
+    for i, digit in enumerate(grid):
+        bit = _VALUE_MASKS.get(digit)
+        if bit and not _iter_assign(board, i, bit, trail):
+            return False
+    return board
+
+
+def _iter_solve(board, trail=None, limit=None):
+    """Generate all possible solved versions of board, without recursion.
+
+    Searches in the same order as _bits_solve, keeping an explicit stack of
+    [square, digits_left_to_try, trail_mark] frames instead of nested
+    generators."""
+    if trail is None:
+        trail = []
+    start = len(trail)
+    stack = []
+    try:
+        while True:
+            # Each board reached is a node, as for _bits_solve.
+            if limit is not None:
+                limit.check()
+            next_i = None
+            fewest = 10
+            for i in range(81):
+                count = MASK_COUNTS[board[i]]
+                if 1 < count < fewest:
+                    next_i = i
+                    fewest = count
+                    if count == 2:
+                        break
+            if next_i is None:
+                yield board
+            else:
+                stack.append([next_i, board[next_i], len(trail)])
+            # Backtrack to the next digit left to try, and assign it.
+            while stack:
+                frame = stack[-1]
+                i, mask, mark = frame
+                _bits_undo(board, trail, mark)
+                if not mask:
+                    stack.pop()
+                    continue
+                bit = mask & -mask
+                frame[1] = mask ^ bit
+                if _iter_assign(board, i, bit, trail):
+                    break
+            else:
+                return
+    finally:
+        _bits_undo(board, trail, start)
+
+
+def _line_keys(grid):
+    """Return (row_keys, column_keys) for grid.
+
+    A key does not change when digits are relabeled or when rows, columns,
+    bands or stacks are reordered, so it can be used to put the lines of
+    equivalent grids in the same order. Each key also takes in the keys of
+    the crossing lines, to break more ties."""
+    frequency = collections.Counter(grid)
+
+    def line_key(line):
+        clues = [i for i in line if grid[i] != '.']
+        return (len(clues),
+                sorted(sum(1 for i in line[s:s + 3] if grid[i] != '.')
+                       for s in range(0, 9, 3)),
+                sorted(frequency[grid[i]] for i in clues))
+
+    row_keys = [line_key(row) for row in ROWS]
+    column_keys = [line_key(column) for column in COLUMNS]
+    refined_rows = [(row_keys[r],
+                     sorted((column_keys[c], frequency[grid[9 * r + c]])
+                            for c in range(9) if grid[9 * r + c] != '.'))
+                    for r in range(9)]
+    refined_columns = [(column_keys[c],
+                        sorted((row_keys[r], frequency[grid[9 * r + c]])
+                               for r in range(9) if grid[9 * r + c] != '.'))
+                       for c in range(9)]
+    return refined_rows, refined_columns
+
+
+def _line_order(line_keys, band_keys):
+    """Return line numbers with bands, and lines within bands, sorted."""
+    bands = sorted(range(3), key=band_keys.__getitem__)
+    return [line for b in bands
+            for line in sorted(range(3 * b, 3 * b + 3),
+                               key=line_keys.__getitem__)]
+
+
+def _map_chunk(function, items):
+    """Return list of function(item) for each item in a chunk."""
+    return [function(item) for item in items]
+
+
+def _rate_canonical(grid):
+    """Return (score, hardest_technique) for a grid in canonical form.
+
+    The last 10000 ratings are remembered, since equivalent grids rate the
+    same."""
+    if grid in _RATINGS:
+        return _RATINGS[grid]
+    rating = _RATINGS[grid] = _rate_grid(grid)
+    if len(_RATINGS) > 10000:
+        _RATINGS.popitem(last=False)
+    return rating
+
+
+def _rate_eliminate(board, i, bit, trail=None):
+    """Eliminate the digit for bit from board[i], and nothing more.
+
+    Unlike _bits_eliminate nothing follows on from it, so rate() can tell
+    which technique each step needs."""
+    mask = board[i]
+    if not mask & bit:
+        return board
+    mask ^= bit
+    board[i] = mask
+    if not mask:
+        return False
+    n = BIT_INDEX[bit]
+    for u, base, position in SLOTS[i]:
+        board[base + n] &= ~position
+        if not board[base + n]:
+            return False
+    return board
+
+
+def _rate_grid(grid):
+    """Return (score, hardest_technique) for grid, or None if it does not
+    have one and only one solution."""
+    board = [ALL_DIGITS_MASK] * (81 + 27 * 9)
+    placed = [False] * 81
+    givens = [(i, DIGIT_MASKS[digit]) for i, digit in enumerate(grid)
+              if digit in DIGITS]
+    if _rate_place(board, placed, givens) is None:
+        return None
+    techniques = [
+        _rate_naked_singles,
+        _rate_hidden_singles,
+        functools.partial(_deduce_pointing, eliminate=_rate_eliminate),
+        functools.partial(_deduce_box_line, eliminate=_rate_eliminate),
+        functools.partial(_deduce_naked_pairs, eliminate=_rate_eliminate),
+        functools.partial(_deduce_hidden_pairs, eliminate=_rate_eliminate),
+        functools.partial(_deduce_naked_triples, eliminate=_rate_eliminate),
+        functools.partial(_deduce_hidden_triples, eliminate=_rate_eliminate),
+        functools.partial(_deduce_x_wing, eliminate=_rate_eliminate),
+    ]
+    score = 0
+    hardest = 0
+    while not all(placed):
+        for k, technique in enumerate(techniques):
+            progress = technique(board, placed)
+            if progress is None:
+                # A contradiction, so there is no solution.
+                return None
+            elif progress:
+                break
+        else:
+            # Only searching would get any further, so make sure
+            # there is just the one solution to be found.
+            if count_solutions(grid, 2) != 1:
+                return None
+            k = len(techniques)
+        score += TECHNIQUES[k][1]
+        hardest = max(hardest, k)
+        if k == len(techniques):
+            break
+    return score, TECHNIQUES[hardest][0]
+
+
+def _rate_hidden_singles(board, placed):
+    """Place every digit that has only one place left in a unit."""
+    singles = []
+    for u, unit in enumerate(UNIT_SQUARES):
+        base = 81 + 9 * u
+        for n in range(9):
+            places = board[base + n]
+            if MASK_COUNTS[places] == 1:
+                i = unit[BIT_INDEX[places]]
+                if not placed[i]:
+                    singles.append((i, 1 << n))
+    return _rate_place(board, placed, singles)
+
+
+def _rate_naked_singles(board, placed):
+    """Place every square that has only one possible digit left."""
+    return _rate_place(board, placed, [(i, board[i]) for i in range(81)
+                                       if not placed[i] and
+                                       MASK_COUNTS[board[i]] == 1])
+
+
+def _rate_one(grid):
+    """Return rate(grid), or None if grid is malformed."""
+    try:
+        return rate(grid)
+    except ValueError:
+        return None
+
+
+def _rate_place(board, placed, singles):
+    """Place each (i, bit) of singles and eliminate it from the peers.
+
+    Return the number of squares placed, or None on a contradiction."""
+    count = 0
+    for i, bit in singles:
+        if placed[i]:
+            continue
+        if not board[i] & bit:
+            return None
+        placed[i] = True
+        count += 1
+        others = board[i] & ~bit
+        if others and not _deduce_eliminate(board, None, i, others,
+                                            _rate_eliminate):
+            return None
+        for peer in PEER_LISTS[i]:
+            if board[peer] & bit and not _rate_eliminate(board, peer, bit):
+                return None
+    return count
+
+
+def _rated_dug_grid(seed, min_assigned_squares, symmetrical):
+    """Return a random (grid, solution, rating) made by digging holes.
+
+    The random module is seeded with seed while digging, and then put back
+    as it was, since this can run in the caller's process."""
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        grid, solution = _bits_dug_grid(min_assigned_squares, symmetrical)
+    finally:
+        random.setstate(state)
+    return grid, solution, _rate_canonical(canonical_form(grid)[0])
+
+
+def _random_grid(min_assigned_squares, symmetrical, limit=None):
+    """Return a random (grid, solution) pair, or False if failed."""
+    min_assigned_squares = max(min_assigned_squares, 17)
+    min_assigned_squares = min(min_assigned_squares, 80)
+    min_unique_digits = 8
+    grid_map = _grid_map_all_digits()
+    mirror = list(reversed(range(81)))
+    assigned_squares = []
+    for i in _shuffled(range(81)):
+        if i in assigned_squares:
+            # Already assigned earlier as a mirror for symmetry.
+            continue
+        if not _assign(grid_map, i, random.choice(grid_map[i])):
+            break
+        assigned_squares.append(i)
+        if symmetrical:
+            # Assign a value to the mirror square as well.
+            other_i = mirror[i]
+            if other_i != i:
+                if not _assign(grid_map, other_i,
+                               random.choice(grid_map[other_i])):
+                    break
+                assigned_squares.append(other_i)
+        unique_digits = {grid_map[i] for i in assigned_squares}
+        if (len(assigned_squares) >= min_assigned_squares and
+                len(unique_digits) >= min_unique_digits):
+            # Sudoku requires a grid with one and only one solution.
+            count = 0
+            for solved_grid_map in _solve(grid_map, limit):
+                count += 1
+                if count > 1:
+                    break
+            if not count == 1:
+                # No solution or more than one solution.
+                break
+            unassigned_squares = set(range(81)) - set(assigned_squares)
+            grid = _to_grid(grid_map, unassigned_squares)
+            solution = _to_grid(solved_grid_map)
+            return grid, solution
+    # Failed to setup a single-solution grid.
+    return False
+
+
+def _search_limit(stats=None, cancel=None, deadline=None, max_nodes=None,
+                  max_attempts=None):
+    """Return a _SearchLimit for the arguments, or None if unlimited."""
+    for name, value in (('max_nodes', max_nodes),
+                        ('max_attempts', max_attempts)):
+        if value is not None and value < 0:
+            raise ValueError('%s must not be negative, not %r.'
+                             % (name, value))
+    if (cancel is None and deadline is None and max_nodes is None and
+            max_attempts is None):
+        return None
+    return _SearchLimit(stats, cancel, deadline, max_nodes, max_attempts)
+
+
+def _search_pool(workers):
+    """Return the SearchPool with workers shared by all callers."""
+    pool = _SEARCH_POOLS.get(workers)
+    if pool is None:
+        pool = _SEARCH_POOLS[workers] = SearchPool(workers)
+    return pool
+
+
+def _shuffled(iterable):
+    """Return shuffled copy of iterable as a list."""
+    l = list(iterable)
+    random.shuffle(l)
+    return l
+
+
+def _size_tables(size):
+    """Return dictionary of lookup tables for a size x size grid.
+
+    Built the first time each size is used. Boards are laid out as for the
+    bitmask engine: size * size square masks, followed by a digit-position
+    mask for each (unit, digit) pair."""
+    _check_size(size)
+    tables = _SIZE_TABLES.get(size)
+    if tables is None:
+        side = int(round(size ** 0.5))
+        squares = size * size
+        rows = [list(range(r * size, (r + 1) * size)) for r in range(size)]
+        columns = [list(range(c, squares, size)) for c in range(size)]
+        boxes = [[(side * b + r) * size + side * s + c
+                  for r in range(side) for c in range(side)]
+                 for b in range(side) for s in range(side)]
+        units = rows + columns + boxes
+        slots = [[] for i in range(squares)]
+        for u, unit in enumerate(units):
+            for p, i in enumerate(unit):
+                slots[i].append((u, squares + size * u, 1 << p))
+        digits = SYMBOLS[:size]
+        tables = _SIZE_TABLES[size] = {
+            'size': size,
+            'side': side,
+            'squares': squares,
+            'digits': digits,
+            'valid_chars': set(digits + digits.lower() + '0.'),
+            'all_mask': (1 << size) - 1,
+            'digit_masks': {digit: 1 << n for n, digit in enumerate(digits)},
+            'units': units,
+            'slots': [tuple(slot) for slot in slots],
+            'peers': [sorted({j for u, base, position in slots[i]
+                              for j in units[u]} - {i})
+                      for i in range(squares)],
+        }
+    return tables
+
+
+def _sized_assign(tables, board, i, bit, trail):
+    """Assign the digit for bit to board[i] and propagate, as _iter_assign.
+
+    Return False if that leads to a contradiction."""
+    others = board[i] & ~bit
+    queue = []
+    while others:
+        other = others & -others
+        queue.append((i, other))
+        others ^= other
+    return _sized_propagate(tables, board, queue, trail)
+
+
+def _sized_dug_grid(tables, min_assigned_squares, symmetrical,
+                    method='assign', limit=None):
+    """Return a random (grid, solution) pair made by digging holes.
+
+    The solution is filled in at random by _sized_random_fill. A hole is
+    dug if its square is a naked or hidden single given the clues left, so
+    the holes can be filled back in, last dug first, one single at a time.
+    That's cheap, as it only needs the digits in each unit. With
+    method='dig', a hole that isn't is still dug if propagation (without
+    any search) still gives the solution, which leaves fewer clues but
+    takes far longer."""
+    size, squares = tables['size'], tables['squares']
+    if limit is not None:
+        limit.check_attempt()
+    board = [tables['all_mask']] * (4 * squares)
+    _sized_random_fill(tables, board, [], limit)
+    solution = _sized_to_grid(tables, board)
+    digit_masks = tables['digit_masks']
+    slots = tables['slots']
+    clues = list(solution)
+    # The digits assigned in each unit.
+    present = [tables['all_mask']] * (3 * size)
+    assigned = squares
+    for i in _shuffled(range(squares)):
+        if clues[i] == '.':
+            # Already removed earlier as a mirror for symmetry.
+            continue
+        holes = sorted({i, squares - 1 - i}) if symmetrical else [i]
+        if assigned - len(holes) < min_assigned_squares:
+            continue
+        if limit is not None:
+            limit.check_time()
+        for hole in holes:
+            clues[hole] = '.'
+            for u, base, position in slots[hole]:
+                present[u] &= ~digit_masks[solution[hole]]
+        if (all(_sized_single(tables, clues, present, hole,
+                              digit_masks[solution[hole]])
+                for hole in holes) or
+                method == 'dig' and
+                _sized_still_unique(tables, clues, solution, holes, 0,
+                                    limit)):
+            assigned -= len(holes)
+        else:
+            for hole in holes:
+                clues[hole] = solution[hole]
+                for u, base, position in slots[hole]:
+                    present[u] |= digit_masks[solution[hole]]
+    return ''.join(clues), solution
+
+
+def _sized_propagate(tables, board, queue, trail):
+    """Carry out the (i, bit) eliminations on queue, as _iter_propagate.
+
+    Digits can be too many for the MASK_COUNTS and BIT_INDEX tables, so
+    single bits are found with mask & (mask - 1), and their index with
+    int.bit_length()."""
+    units = tables['units']
+    slots = tables['slots']
+    peers = tables['peers']
+    pop = queue.pop
+    push = queue.append
+    while queue:
+        i, bit = pop()
+        mask = board[i]
+        if not mask & bit:
+            continue
+        trail.append((i, mask))
+        mask ^= bit
+        board[i] = mask
+        if not mask:
+            return False
+        n = bit.bit_length() - 1
+        for u, base, position in slots[i]:
+            places = board[base + n] & ~position
+            board[base + n] = places
+            if not places:
+                return False
+            elif not places & (places - 1):
+                # Only one place left in the unit for this digit.
+                other_i = units[u][places.bit_length() - 1]
+                others = board[other_i] & ~bit
+                while others:
+                    other = others & -others
+                    push((other_i, other))
+                    others ^= other
+        if not mask & (mask - 1):
+            for peer in peers[i]:
+                if board[peer] & mask:
+                    push((peer, mask))
+    return True
+
+
+def _sized_propagated(tables, grid):
+    """Return board for a grid of any size, or False if it can't be solved."""
+    board = [tables['all_mask']] * (4 * tables['squares'])
+    trail = []
+    digit_masks = tables['digit_masks']
+    for i, digit in enumerate(grid):
+        if (digit in digit_masks and
+                not _sized_assign(tables, board, i, digit_masks[digit],
+                                  trail)):
+            return False
+    return board
+
+
+def _sized_random_fill(tables, board, trail, limit=None):
+    """Assign random digits to every square of board, as _bits_random_fill,
+    but without recursion, as _sized_solve.
+
+    Return False if board has no solution."""
+    squares = tables['squares']
+    stack = []
+    while True:
+        next_i = None
+        fewest = tables['size'] + 1
+        for i in range(squares):
+            mask = board[i]
+            if mask & (mask - 1):
+                count = bin(mask).count('1')
+                if count < fewest:
+                    next_i = i
+                    fewest = count
+                    if count == 2:
+                        break
+        if next_i is None:
+            return True
+        if limit is not None:
+            limit.check()
+        mask = board[next_i]
+        bits = _shuffled(1 << n for n in range(tables['size'])
+                         if mask & 1 << n)
+        stack.append((next_i, bits, len(trail)))
+        # Backtrack to the next digit left to try, and assign it.
+        while stack:
+            i, bits, mark = stack[-1]
+            _sized_undo(tables, board, trail, mark)
+            if not bits:
+                stack.pop()
+                continue
+            if _sized_assign(tables, board, i, bits.pop(), trail):
+                break
+        else:
+            return False
+
+
+def _sized_single(tables, clues, present, i, bit):
+    """Return True if bit is a naked or hidden single for the hole at i.
+
+    Present has the mask of digits assigned in each unit, so a hole can't
+    have any digit present in one of its units."""
+    slots = tables['slots']
+    taken = 0
+    for u, base, position in slots[i]:
+        taken |= present[u]
+    if taken | bit == tables['all_mask']:
+        return True
+    for u, base, position in slots[i]:
+        for j in tables['units'][u]:
+            if j != i and clues[j] == '.':
+                if not any(present[v] & bit for v, b, p in slots[j]):
+                    break
+        else:
+            return True
+    return False
+
+
+def _sized_solve(tables, board, trail=None, max_nodes=None, limit=None):
+    """Generate all possible solved versions of board, as _iter_solve.
+
+    Give up by generating None after branching max_nodes times."""
+    squares = tables['squares']
+    if trail is None:
+        trail = []
+    start = len(trail)
+    stack = []
+    nodes = 0
+    try:
+        while True:
+            if limit is not None:
+                limit.check()
+            next_i = None
+            fewest = tables['size'] + 1
+            for i in range(squares):
+                mask = board[i]
+                if mask & (mask - 1):
+                    count = bin(mask).count('1')
+                    if count < fewest:
+                        next_i = i
+                        fewest = count
+                        if count == 2:
+                            break
+            if next_i is None:
+                yield board
+            elif nodes == max_nodes:
+                yield None
+                return
+            else:
+                nodes += 1
+                stack.append([next_i, board[next_i], len(trail)])
+            # Backtrack to the next digit left to try, and assign it.
+            while stack:
+                frame = stack[-1]
+                i, mask, mark = frame
+                _sized_undo(tables, board, trail, mark)
+                if not mask:
+                    stack.pop()
+                    continue
+                bit = mask & -mask
+                frame[1] = mask ^ bit
+                if _sized_assign(tables, board, i, bit, trail):
+                    break
+            else:
+                return
+    finally:
+        _sized_undo(tables, board, trail, start)
+
+
+def _sized_still_unique(tables, clues, solution, holes, max_nodes=None,
+                        limit=None):
+    """Return True if solution is the only solution, as _bits_still_unique.
+
+    Also return False if that can't be shown within max_nodes branches of
+    the search for another solution."""
+    board = _sized_propagated(tables, clues)
+    trail = []
+    digit_masks = tables['digit_masks']
+    for hole in holes:
+        bit = digit_masks[solution[hole]]
+        mark = len(trail)
+        if _sized_propagate(tables, board, [(hole, bit)], trail):
+            for solved_board in _sized_solve(tables, board, trail, max_nodes,
+                                             limit):
+                return False
+        _sized_undo(tables, board, trail, mark)
+        # Any other solution must differ at a later hole instead.
+        _sized_assign(tables, board, hole, bit, trail)
+    return True
+
+
+def _sized_to_grid(tables, board):
+    """Return grid string for a board of any size."""
+    digits = tables['digits']
+    return ''.join(digits[mask.bit_length() - 1]
+                   if not mask & (mask - 1) else '.'
+                   for mask in board[:tables['squares']])
+
+
+def _sized_undo(tables, board, trail, mark):
+    """Pop trail back down to mark, as _bits_undo."""
+    slots = tables['slots']
+    while len(trail) > mark:
+        i, mask = trail.pop()
+        n = (mask ^ board[i]).bit_length() - 1
+        board[i] = mask
+        for u, base, position in slots[i]:
+            board[base + n] |= position
+
+
+def _solve(grid_map, limit=None):
+    """Generate all possible solved versions of grid_map using brute force."""
+    if not grid_map:
+        return
+    if limit is not None:
+        limit.check()
+    if all(len(grid_map[i]) == 1 for i in range(81)):
+        yield grid_map
+        return
+    next_i = min((len(grid_map[i]), i) for i in range(81)
+                 if len(grid_map[i]) > 1)[1]
+    possible_digits = grid_map[next_i]
+    for digit in possible_digits:
+        for solved_grid_map in _solve(_assign(grid_map.copy(), next_i, digit),
+                                      limit):
+            yield solved_grid_map
+
+
+def _solve_list(grid, max_solutions=None, **kwargs):
+    """Return list of up to max_solutions solutions for grid."""
+    return list(itertools.islice(solve(grid, **kwargs), max_solutions))
+
+
+def _solve_one(grid, max_solutions=None, engine='bitmask'):
+    """Return list of up to max_solutions solutions, or None if malformed."""
+    try:
+        return list(itertools.islice(solve(grid, engine), max_solutions))
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_grid(grid_map, unassigned_squares=[]):
+    """Return grid string for a grid_map dictionary.
+
+    Use a dot for an unassigned square, rather than its propogated value."""
+    return ''.join(grid_map[i]
+                   if len(grid_map[i]) == 1
+                   and i not in unassigned_squares else '.'
+                   for i in range(81))
+
+
+def _topology(size):
+    """Return the shared Topology for a size x size grid."""
+    topology = _TOPOLOGIES.get(size)
+    if topology is None:
+        topology = _TOPOLOGIES[size] = Topology(size)
+    return topology
+
+
+#==============================================================================
+# And now for something completely different: Python Classes
+#==============================================================================
+
+
+class Puzzle(object):
+    """Puzzle class.
+
+    The layout of the grid is a Topology shared by every puzzle of the same
+    size, so a puzzle itself only holds compact arrays: the current and
+    solved digit number of each square (0 if none), whether it was
+    assigned, its possible digits as a bitmask, and a count of each digit
+    in each unit. The Square, Row, Column and Box objects are views onto
+    those arrays, made when first asked for.
+
+    Each square's possible_digits_changed signal is emitted when its
+    possible digits change, and squares_changed is emitted with the set
+    of squares changed by each update, reset or batch_update() block.
+
+    Updates, resets, setups and restores can be undone and redone, keeping
+    the last history of them.
+
+    The first call to next_hint(), forced_cells() or conflicts() builds a
+    count of the places left for each digit in each unit, and the sets of
+    naked singles, hidden singles and duplicated digits, which updates
+    then keep up to date, so later calls cost as much as what they
+    return."""
+
+    __slots__ = ('size', 'topology', 'history', 'squares_changed',
+                 '_values', '_solved', '_assigned', '_candidates', '_counts',
+                 '_present', '_squares', '_units', '_signals', '_batch_depth',
+                 '_batch_old_masks', '_batch_edits', '_undo', '_redo',
+                 '_places', '_naked', '_hidden', '_duplicates', '__weakref__')
+
+    def __init__(self, size=9, history=100):
+        """Create a Puzzle instance for a size x size grid (see SIZES)."""
+        self.size = size
+        self.topology = _topology(size)
+        self.history = history
+        self.squares_changed = Signal()
+        self._squares = None
+        self._units = None
+        self._signals = None
+        self._batch_depth = 0
+        self._batch_old_masks = {}
+        self._batch_edits = []
+        self._undo = None
+        self._redo = None
+        self._clear()
+
+    @property
+    def digits(self):
+        """Return set of the digits used by the puzzle."""
+        return self.topology.digit_set
+
+    @property
+    def squares(self):
+        """Return list of the squares, by row then column."""
+        if self._squares is None:
+            self._squares = [Square(self, i)
+                             for i in range(self.size * self.size)]
+        return self._squares
+
+    @property
+    def rows(self):
+        """Return list of the rows."""
+        return self._get_units()[0:self.size]
+
+    @property
+    def columns(self):
+        """Return list of the columns."""
+        return self._get_units()[self.size:2 * self.size]
+
+    @property
+    def boxes(self):
+        """Return list of the boxes."""
+        return self._get_units()[2 * self.size:]
+
+    @property
+    def box_finder(self):
+        """Return the shared {(row, column): box} dictionary (from 0)."""
+        return self.topology.box_finder
+
+    @property
+    def mirror(self):
+        """Return dictionary of each square to its mirror image square."""
+        return dict(zip(self.squares, reversed(self.squares)))
+
+    @property
+    def assigned_digits(self):
+        """Return set of digits that have been successfully assigned."""
+        digits = self.topology.digits
+        return {digits[value - 1]
+                for value, assigned in zip(self._values, self._assigned)
+                if value and assigned}
+
+    @property
+    def assigned_squares(self):
+        """Return list of squares with assigned values."""
+        squares = self.squares
+        return [squares[i] for i, assigned in enumerate(self._assigned)
+                if assigned]
+
+    @property
+    def assigned_grid(self):
+        """Return the assigned grid as a size * size character string."""
+        digits = self.topology.digits
+        return ''.join(digits[value - 1] if value and assigned else '.'
+                       for value, assigned in zip(self._values,
+                                                  self._assigned))
+
+    @property
+    def current_grid(self):
+        """Return the current grid as a size * size character string."""
+        digits = self.topology.digits
+        return ''.join(digits[value - 1] if value else '.'
+                       for value in self._values)
+
+    @property
+    def solved_grid(self):
+        """Return the solved grid as a size * size character string."""
+        digits = self.topology.digits
+        return ''.join(digits[value - 1] if value else '.'
+                       for value in self._solved)
+
+    @property
+    def is_solved(self):
+        """Return True if all squares have been solved."""
+        return all(value and value == solved
+                   for value, solved in zip(self._values, self._solved))
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """Defer signals until the end of the with block.
+
+        Each square that changed is then signalled once, if its possible
+        digits differ from before the block, followed by squares_changed.
+        Blocks can be nested; only the outermost one signals."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._flush_edits()
+                old_masks = self._batch_old_masks
+                self._batch_old_masks = {}
+                self._emit_changed(old_masks)
+
+    @property
+    def can_redo(self):
+        """Return True if there is something to redo."""
+        return bool(self._redo)
+
+    @property
+    def can_undo(self):
+        """Return True if there is something to undo."""
+        return bool(self._undo)
+
+    def conflicts(self):
+        """Return list of squares whose value is also in one of its units."""
+        self._track()
+        size = self.size
+        values = self._values
+        unit_squares = self.topology.unit_squares
+        indices = set()
+        for k in self._duplicates:
+            u, n = divmod(k, size)
+            indices.update(i for i in unit_squares[u] if values[i] == n + 1)
+        squares = self.squares
+        return [squares[i] for i in sorted(indices)]
+
+    def forced_cells(self):
+        """Return {square: digit} dictionary of every naked or hidden single.
+
+        A naked single is an empty square with only one possible digit,
+        and a hidden single the only place left for a digit in a unit."""
+        self._track()
+        squares = self.squares
+        digits = self.topology.digits
+        forced = {}
+        for i in sorted(self._naked):
+            forced[squares[i]] = digits[self._candidates[i].bit_length() - 1]
+        for i, n in self._hidden_singles():
+            forced.setdefault(squares[i], digits[n])
+        return forced
+
+    def next_hint(self):
+        """Return (square, digit, technique) for the next move, or None.
+
+        The technique is 'naked_single' or 'hidden_single' (as for rate()),
+        or 'search' if there are neither, when the hint is the solved value
+        of an empty square with the fewest possible digits. None means the
+        puzzle is full, or has no solution to give a hint from."""
+        self._track()
+        squares = self.squares
+        digits = self.topology.digits
+        if self._naked:
+            i = min(self._naked)
+            n = self._candidates[i].bit_length() - 1
+            return squares[i], digits[n], 'naked_single'
+        for i, n in self._hidden_singles():
+            return squares[i], digits[n], 'hidden_single'
+        empty = [i for i, value in enumerate(self._values)
+                 if not value and self._solved[i]]
+        if not empty:
+            return None
+        i = min(empty, key=lambda i: bin(self._candidates[i]).count('1'))
+        return squares[i], digits[self._solved[i] - 1], 'search'
+
+    def redo(self):
+        """Redo the last change undone, returning False if there wasn't one."""
+        self._flush_edits()
+        if not self._redo:
+            return False
+        self._undo.append(self._apply(self._redo.pop(), False))
+        return True
+
+    def reset(self):
+        """Reset the puzzle back to a clean slate."""
+        self._push_snapshot()
+        self._reset()
+
+    def restore(self, snapshot):
+        """Restore the state saved by snapshot(), which can be undone.
+
+        Only squares whose possible digits differ are signalled. Return
+        list of those squares."""
+        if snapshot.size != self.size:
+            raise ValueError('Snapshot is of a %dx%d puzzle.'
+                             % (snapshot.size, snapshot.size))
+        self._push_snapshot()
+        squares = self.squares
+        return [squares[i] for i in self._restore(snapshot)]
+
+    def snapshot(self):
+        """Return a PuzzleSnapshot of the puzzle's state, for restore().
+
+        It's a copy of the puzzle's arrays, a few hundred bytes, and can be
+        pickled to checkpoint a session."""
+        return PuzzleSnapshot(self.size, bytes(self._values),
+                              bytes(self._solved), bytes(self._assigned),
+                              self._candidates.tobytes(), bytes(self._counts),
+                              self._present.tobytes())
+
+    def undo(self):
+        """Undo the last change, returning False if there wasn't one.
+
+        A change is an update (or a batch_update() block of them), or a
+        reset, setup_random_grid() or restore()."""
+        self._flush_edits()
+        if not self._undo:
+            return False
+        self._redo.append(self._apply(self._undo.pop(), True))
+        return True
+
+    def setup_random_grid(self, min_assigned_squares=40, symmetrical=True,
+                          method='assign', pool=None):
+        """Setup random grid with a min of 26 to a max of 80 squares assigned.
+
+        Processing less than 26 assigned squares can take a long time,
+        unless method is 'dig', which allows a minimum of 17.
+        If pool is a PuzzlePool the grid is taken from it when it has one
+        ready, and the pool's method is used. Pools only hold 9x9 grids;
+        other sizes take their minimum as random_grid() does."""
+        if pool is not None and self.size != 9:
+            raise ValueError('Puzzle pools only hold 9x9 grids.')
+        self._set_grid(*self._random_grid(min_assigned_squares, symmetrical,
+                                          method, pool))
+
+    async def async_setup_random_grid(self, min_assigned_squares=40,
+                                      symmetrical=True, method='assign',
+                                      pool=None, timeout=None, runner=None):
+        """Setup random grid as setup_random_grid() does, without blocking.
+
+        The grid is made as async_random_grid() makes it, and the puzzle
+        is left as it was if that is cancelled or times out. Signals are
+        emitted from the event loop's thread."""
+        if pool is not None and self.size != 9:
+            raise ValueError('Puzzle pools only hold 9x9 grids.')
+        runner = runner or _async_runner()
+        self._set_grid(*await _async_wait(runner.run(
+            self._random_grid, min_assigned_squares, symmetrical, method,
+            pool), timeout))
+
+    def _apply(self, change, undoing):
+        """Undo (or redo) change, returning what will redo (or undo) it.
+
+        A change is a PuzzleSnapshot of the state before (or after) it, or
+        a list of (square_index, old_digit, new_digit) edits."""
+        with self.batch_update():
+            if isinstance(change, PuzzleSnapshot):
+                current = self.snapshot()
+                self._restore(change)
+                return current
+            for i, old_digit, digit in (reversed(change) if undoing
+                                        else change):
+                self._update(i, old_digit if undoing else digit)
+        return change
+
+    def _changed(self, old_masks):
+        """Signal squares whose possible digits changed.
+
+        Old_masks is a {square_index: previous_mask} dictionary. Inside
+        batch_update() the signals wait for the end of the block."""
+        if self._batch_depth:
+            for i, mask in old_masks.items():
+                self._batch_old_masks.setdefault(i, mask)
+        else:
+            self._emit_changed(old_masks)
+
+    def _edit(self, i, digit):
+        """Update square i with the value of digit, so it can be undone."""
+        value = self._values[i]
+        edit = (i, self.topology.digits[value - 1] if value else None,
+                digit or None)
+        if self._batch_depth:
+            self._batch_edits.append(edit)
+        else:
+            self._push_undo([edit])
+        return self._update(i, digit)
+
+    def _clear(self):
+        """Set the arrays to those of an empty grid."""
+        topology = self.topology
+        squares = self.size * self.size
+        self._values = bytearray(squares)
+        self._solved = bytearray(squares)
+        self._assigned = bytearray(squares)
+        self._candidates = array.array(topology.typecode,
+                                       [topology.all_mask]) * squares
+        self._counts = bytearray(3 * self.size * self.size)
+        self._present = array.array(topology.typecode, [0]) * (3 * self.size)
+        self._places = None
+
+    def _emit_changed(self, old_masks):
+        """Emit signals for squares whose masks differ from old_masks."""
+        candidates = self._candidates
+        changed = sorted(i for i, mask in old_masks.items()
+                         if candidates[i] != mask)
+        if not changed:
+            return
+        if self._signals:
+            for i in changed:
+                signal = self._signals.get(i)
+                if signal is not None:
+                    signal.emit()
+        if self.squares_changed._slots:
+            squares = self.squares
+            self.squares_changed.emit({squares[i] for i in changed})
+
+    def _flush_edits(self):
+        """Push the edits made so far in a batch_update() block as a change,
+        so changes pushed after them stay in order."""
+        if self._batch_edits:
+            edits = self._batch_edits
+            self._batch_edits = []
+            self._push_undo(edits)
+
+    def _hidden_singles(self):
+        """Generate (square_index, digit_number) for each hidden single."""
+        size = self.size
+        candidates = self._candidates
+        unit_squares = self.topology.unit_squares
+        for k in sorted(self._hidden):
+            u, n = divmod(k, size)
+            bit = 1 << n
+            for i in unit_squares[u]:
+                if candidates[i] & bit:
+                    yield i, n
+                    break
+
+    def _push_snapshot(self):
+        """Push a snapshot of the puzzle onto the undo history."""
+        self._flush_edits()
+        self._push_undo(self.snapshot())
+
+    def _push_undo(self, change):
+        """Push change onto the undo history, and forget any redos."""
+        if not self.history:
+            return
+        if self._undo is None:
+            self._undo = collections.deque(maxlen=self.history)
+            self._redo = []
+        self._undo.append(change)
+        del self._redo[:]
+
+    def _reset(self):
+        """Reset the puzzle back to a clean slate, without any history."""
+        all_mask = self.topology.all_mask
+        old_masks = {i: mask for i, mask in enumerate(self._candidates)
+                     if mask != all_mask}
+        self._clear()
+        self._changed(old_masks)
+
+    def _restore(self, snapshot):
+        """Restore the arrays from snapshot, signalling squares that changed.
+
+        Return list of the indices of those squares."""
+        old_candidates = self._candidates
+        self._values = bytearray(snapshot.values)
+        self._solved = bytearray(snapshot.solved)
+        self._assigned = bytearray(snapshot.assigned)
+        self._candidates = array.array(self.topology.typecode)
+        self._candidates.frombytes(snapshot.candidates)
+        self._counts = bytearray(snapshot.counts)
+        self._present = array.array(self.topology.typecode)
+        self._present.frombytes(snapshot.present)
+        self._places = None
+        if old_candidates == self._candidates:
+            return []
+        old_masks = {i: mask for i, (mask, new_mask) in
+                     enumerate(zip(old_candidates, self._candidates))
+                     if mask != new_mask}
+        self._changed(old_masks)
+        return sorted(old_masks)
+
+    def _get_units(self):
+        """Return list of the rows, columns and boxes, made on first use."""
+        if self._units is None:
+            size = self.size
+            self._units = ([Row(self, u) for u in range(size)] +
+                           [Column(self, u) for u in range(size, 2 * size)] +
+                           [Box(self, u) for u in range(2 * size, 3 * size)])
+        return self._units
+
+    def _random_grid(self, min_assigned_squares, symmetrical, method, pool,
+                     cancel=None):
+        """Return the (grid, solution) pair for setup_random_grid()."""
+        if pool is not None:
+            method = pool.method
+        if self.size == 9:
+            min_assigned_squares = max(min_assigned_squares,
+                                       17 if method == 'dig' else 26)
+        if pool is not None:
+            return pool.get(min_assigned_squares, symmetrical, cancel)
+        return random_grid(min_assigned_squares, symmetrical, method=method,
+                           size=self.size, cancel=cancel)
+
+    def _set_grid(self, grid, solution):
+        """Setup the (grid, solution) pair, as one undoable change."""
+        self._push_snapshot()
+        with self.batch_update():
+            self._reset()
+            digit_index = self.topology.digit_index
+            for i, digit in enumerate(solution):
+                self._solved[i] = digit_index[digit] + 1
+                if grid[i] != '.':
+                    self._update(i, grid[i])
+                    self._assigned[i] = 1
+
+    def _signal(self, i):
+        """Return the possible_digits_changed signal of square i."""
+        if self._signals is None:
+            self._signals = {}
+        signal = self._signals.get(i)
+        if signal is None:
+            signal = self._signals[i] = Signal()
+        return signal
+
+    def _track(self):
+        """Build the state used for hints and conflicts, if not yet built.
+
+        From then on _update() keeps it up to date, until a reset or
+        restore throws it away."""
+        if self._places is not None:
+            return
+        size = self.size
+        square_units = self.topology.square_units
+        places = bytearray(3 * size * size)
+        for i, mask in enumerate(self._candidates):
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                for u in square_units[i]:
+                    places[size * u + bit.bit_length() - 1] += 1
+        self._places = places
+        self._naked = set()
+        self._hidden = set()
+        self._duplicates = {k for k, count in enumerate(self._counts)
+                            if count > 1}
+        for i in range(size * size):
+            self._track_naked(i)
+        for k in range(len(places)):
+            self._track_hidden(k)
+
+    def _track_hidden(self, k):
+        """Keep (unit, digit) number k in _hidden if it's a hidden single."""
+        u, n = divmod(k, self.size)
+        if self._places[k] == 1 and not self._present[u] & (1 << n):
+            self._hidden.add(k)
+        else:
+            self._hidden.discard(k)
+
+    def _track_naked(self, i):
+        """Keep square i in _naked if it's a naked single."""
+        mask = self._candidates[i]
+        if not self._values[i] and mask and not mask & (mask - 1):
+            self._naked.add(i)
+        else:
+            self._naked.discard(i)
+
+    def _update(self, i, digit):
+        """Update square i with the value of digit.
+
+        Only squares in a unit where a digit appeared or disappeared need
+        their possible digits recalculated, rather than every peer. Return
+        list of the indices of squares whose possible digits changed."""
+        topology = self.topology
+        size = self.size
+        tracking = self._places is not None
+        old_value = self._values[i]
+        value = topology.digit_index[digit] + 1 if digit else 0
+        self._values[i] = value
+        counts = self._counts
+        present = self._present
+        units = []
+        for u in topology.square_units[i]:
+            if old_value:
+                k = size * u + old_value - 1
+                counts[k] -= 1
+                if not counts[k]:
+                    present[u] &= ~(1 << (old_value - 1))
+                    units.append(u)
+                if tracking:
+                    if counts[k] == 1:
+                        self._duplicates.discard(k)
+                    self._track_hidden(k)
+            if value:
+                k = size * u + value - 1
+                counts[k] += 1
+                if counts[k] == 1:
+                    present[u] |= 1 << (value - 1)
+                    units.append(u)
+                if tracking:
+                    if counts[k] == 2:
+                        self._duplicates.add(k)
+                    self._track_hidden(k)
+        squares = {i}
+        for u in units:
+            squares.update(topology.unit_squares[u])
+        values = self._values
+        candidates = self._candidates
+        places = self._places
+        all_mask = topology.all_mask
+        square_units = topology.square_units
+        old_masks = {}
+        for j in sorted(squares):
+            if values[j]:
+                mask = 1 << (values[j] - 1)
+            else:
+                r, c, b = square_units[j]
+                mask = all_mask & ~(present[r] | present[c] | present[b])
+            old_mask = candidates[j]
+            if mask != old_mask:
+                old_masks[j] = old_mask
+                candidates[j] = mask
+                if tracking:
+                    flipped = mask ^ old_mask
+                    while flipped:
+                        bit = flipped & -flipped
+                        flipped ^= bit
+                        step = 1 if mask & bit else -1
+                        for u in square_units[j]:
+                            k = size * u + bit.bit_length() - 1
+                            places[k] += step
+                            self._track_hidden(k)
+            if tracking:
+                self._track_naked(j)
+        self._changed(old_masks)
+        return sorted(old_masks)
+
+
+class PuzzlePool(object):
+    """Ready-made random (grid, solution) pairs, refilled in the background.
+
+    Pairs are kept per (min_assigned_squares, symmetrical) key. Whenever a
+    key drops below low_water pairs, random_grid() jobs are sent to the
+    executor (a process pool of workers, by default) until there will be
+    high_water pairs again. If a key has nothing ready, get() makes a pair
+    itself, which counts as a miss."""
+
+    def __init__(self, low_water=10, high_water=50, workers=1, method='assign',
+                 executor=None):
+        """Create a PuzzlePool instance."""
+        self.low_water = low_water
+        self.high_water = max(high_water, low_water)
+        self.workers = workers
+        self.method = method
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_seconds = 0.0
+        self.max_refill_seconds = 0.0
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()
+        self._puzzles = collections.defaultdict(collections.deque)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return sum(len(puzzles) for puzzles in self._puzzles.values())
+
+    def close(self):
+        """Stop refilling, without waiting for jobs already running."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def fill(self, min_assigned_squares=40, symmetrical=True):
+        """Start refilling key to high_water, and return the futures."""
+        import concurrent.futures
+        key = (min_assigned_squares, symmetrical)
+        with self._lock:
+            wanted = (self.high_water - len(self._puzzles[key]) -
+                      self._pending[key])
+            self._pending[key] += max(wanted, 0)
+            if self._executor is None and wanted > 0:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers)
+            executor = self._executor
+        futures = []
+        for n in range(wanted):
+            try:
+                future = executor.submit(
+                    random_grid, min_assigned_squares, symmetrical,
+                    method=self.method)
+            except RuntimeError:
+                # The pool was closed meanwhile, so stop refilling.
+                with self._lock:
+                    self._pending[key] -= wanted - n
+                break
+            future.add_done_callback(functools.partial(
+                self._refilled, key, time.time()))
+            futures.append(future)
+        return futures
+
+    def get(self, min_assigned_squares=40, symmetrical=True, cancel=None):
+        """Return a (grid, solution) pair, and refill if running low.
+
+        A miss passes cancel on to random_grid()."""
+        key = (min_assigned_squares, symmetrical)
+        with self._lock:
+            puzzles = self._puzzles[key]
+            result = puzzles.popleft() if puzzles else None
+            if result:
+                self.hits += 1
+            else:
+                self.misses += 1
+            low = len(puzzles) + self._pending[key] < self.low_water
+        if low:
+            self.fill(min_assigned_squares, symmetrical)
+        if not result:
+            result = random_grid(min_assigned_squares, symmetrical,
+                                 method=self.method, cancel=cancel)
+        return result
+
+    def load(self, path):
+        """Add the pairs saved to path by save()."""
+        import json
+        with open(path) as f:
+            saved = json.load(f)
+        with self._lock:
+            for key, pairs in saved.items():
+                min_assigned_squares, symmetrical = key.split(',')
+                key = (int(min_assigned_squares), symmetrical == 'True')
+                self._puzzles[key].extend(tuple(pair) for pair in pairs)
+
+    def save(self, path):
+        """Save the pairs that are ready to path as JSON."""
+        import json
+        with self._lock:
+            saved = {'%d,%s' % key: list(puzzles)
+                     for key, puzzles in self._puzzles.items() if puzzles}
+        with open(path, 'w') as f:
+            json.dump(saved, f)
+
+    def stats(self):
+        """Return dictionary of counters for the pool."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'ready': sum(len(p) for p in self._puzzles.values()),
+                'pending': sum(self._pending.values()),
+                'refills': self.refills,
+                'refill_seconds': self.refill_seconds,
+                'max_refill_seconds': self.max_refill_seconds,
+            }
+
+    def _refilled(self, key, submitted, future):
+        """Add the pair made by a finished refill job."""
+        lag = time.time() - submitted
+        with self._lock:
+            self._pending[key] -= 1
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._puzzles[key].append(future.result())
+            self.refills += 1
+            self.refill_seconds += lag
+            self.max_refill_seconds = max(self.max_refill_seconds, lag)
+
+
+class PuzzleSnapshot(object):
+    """The state of a Puzzle, as returned by Puzzle.snapshot().
+
+    Holds immutable bytes copies of the puzzle's arrays."""
+
+    __slots__ = ('size', 'values', 'solved', 'assigned', 'candidates',
+                 'counts', 'present')
+
+    def __init__(self, size, values, solved, assigned, candidates, counts,
+                 present):
+        self.size = size
+        self.values = values
+        self.solved = solved
+        self.assigned = assigned
+        self.candidates = candidates
+        self.counts = counts
+        self.present = present
+
+    def __eq__(self, other):
+        return (isinstance(other, PuzzleSnapshot) and
+                self._state() == other._state())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._state())
+
+    def __getstate__(self):
+        return self._state()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def _state(self):
+        """Return tuple of the snapshot's attributes."""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class Topology(object):
+    """The layout of a size x size grid, shared by all puzzles that size.
+
+    Use _topology(size) to get the one for a size. Units are numbered rows
+    first, then columns, then boxes, and squares by row then column."""
+
+    __slots__ = ('size', 'digits', 'digit_set', 'digit_index', 'all_mask',
+                 'typecode', 'box_finder', 'square_units', 'unit_squares',
+                 'peers', '_digit_sets')
+
+    def __init__(self, size):
+        _check_size(size)
+        side = int(round(size ** 0.5))
+        self.size = size
+        self.digits = SYMBOLS[:size]
+        self.digit_set = frozenset(self.digits)
+        self.digit_index = {digit: n for n, digit in enumerate(self.digits)}
+        self.all_mask = (1 << size) - 1
+        self.typecode = 'H' if size <= 16 else 'L'
+        self.box_finder = {(r, c): side * (r // side) + c // side
+                           for r in range(size) for c in range(size)}
+        self.square_units = tuple(
+            (i // size, size + i % size,
+             2 * size + self.box_finder[(i // size, i % size)])
+            for i in range(size * size))
+        unit_squares = [[] for u in range(3 * size)]
+        for i, units in enumerate(self.square_units):
+            for u in units:
+                unit_squares[u].append(i)
+        self.unit_squares = tuple(tuple(squares) for squares in unit_squares)
+        self.peers = tuple(
+            tuple(sorted({j for u in units for j in unit_squares[u]} - {i}))
+            for i, units in enumerate(self.square_units))
+        self._digit_sets = {}
+
+    def __repr__(self):
+        return '<Topology %dx%d>' % (self.size, self.size)
+
+    def digits_of(self, mask):
+        """Return frozenset of the digits in mask, cached per mask."""
+        digit_set = self._digit_sets.get(mask)
+        if digit_set is None:
+            digit_set = self._digit_sets[mask] = frozenset(
+                digit for n, digit in enumerate(self.digits)
+                if mask & (1 << n))
+        return digit_set
+
+
+class Unit(object):
+    """Parent class for Row, Column and Box.
+
+    A view of unit number index of puzzle (see Topology). The puzzle keeps
+    a count of each digit among the current values of the unit's squares,
+    and a mask of the digits present, so squares needn't ask their peers."""
+
+    __slots__ = ('puzzle', 'index')
+
+    def __init__(self, puzzle, index):
+        self.puzzle = puzzle
+        self.index = index
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.number)
+
+    @property
+    def number(self):
+        """Return the number of the unit, from 1, among its kind."""
+        return self.index % self.puzzle.size + 1
+
+    @property
+    def name(self):
+        """Return the number of the unit as a string."""
+        return str(self.number)
+
+    @property
+    def squares(self):
+        """Return list of the squares in the unit."""
+        squares = self.puzzle.squares
+        return [squares[i] for i in self.puzzle.topology.unit_squares[
+            self.index]]
+
+    @property
+    def digit_counts(self):
+        """Return Counter of the digits among the squares' current values."""
+        puzzle = self.puzzle
+        start = puzzle.size * self.index
+        counts = puzzle._counts[start:start + puzzle.size]
+        return collections.Counter(
+            {digit: count
+             for digit, count in zip(puzzle.topology.digits, counts)
+             if count})
+
+    @property
+    def present_digits(self):
+        """Return frozenset of the digits among the squares' current values."""
+        return self.puzzle.topology.digits_of(
+            self.puzzle._present[self.index])
+
+
+class Row(Unit):
+    __slots__ = ()
+
+
+class Column(Unit):
+    __slots__ = ()
+
+
+class Box(Unit):
+    __slots__ = ()
 
 
 class Signal(object):
     """Notifies connected slots when emit() is called."""
 
+    __slots__ = ('_slots',)
+
     def __init__(self):
         self._slots = set()
 
@@ -436,30 +3422,91 @@ class Signal(object):
 
 
 class Square(object):
-    """Square class."""
+    """Square class.
 
-    def __init__(self, number, puzzle, row, column, box):
+    A view of square number index of puzzle; its values are kept in the
+    puzzle's arrays."""
+
+    __slots__ = ('puzzle', 'index')
+
+    def __init__(self, puzzle, index):
         """Create a Square instance."""
-        self.number = number
-        self.name = str(number)
         self.puzzle = puzzle
-        self.row = row
-        self.column = column
-        self.box = box
-        row.squares.append(self)
-        column.squares.append(self)
-        box.squares.append(self)
-        self.peers = set()
-        self.possible_digits = DIGITS
-        self.current_value = None
-        self.solved_value = None
-        self.was_assigned = False
-        self.possible_digits_changed = Signal()
+        self.index = index
 
     def __repr__(self):
         return '<Square %s @ Row:%s Col:%s Digit(s):%s>' % (
             self.name, self.row.number, self.column.number,
-            ''.join(self.possible_digits))
+            ''.join(sorted(self.possible_digits)))
+
+    @property
+    def number(self):
+        """Return the number of the square, from 1."""
+        return self.index + 1
+
+    @property
+    def name(self):
+        """Return the number of the square as a string."""
+        return str(self.index + 1)
+
+    @property
+    def row(self):
+        """Return the Row the square is in."""
+        return self.puzzle.rows[self.index // self.puzzle.size]
+
+    @property
+    def column(self):
+        """Return the Column the square is in."""
+        return self.puzzle.columns[self.index % self.puzzle.size]
+
+    @property
+    def box(self):
+        """Return the Box the square is in."""
+        u = self.puzzle.topology.square_units[self.index][2]
+        return self.puzzle.boxes[u - 2 * self.puzzle.size]
+
+    @property
+    def peers(self):
+        """Return set of the squares sharing a unit with this square."""
+        squares = self.puzzle.squares
+        return {squares[i] for i in self.puzzle.topology.peers[self.index]}
+
+    @property
+    def possible_digits(self):
+        """Return frozenset of the digits still possible for the square."""
+        return self.puzzle.topology.digits_of(
+            self.puzzle._candidates[self.index])
+
+    @property
+    def possible_digits_changed(self):
+        """Return the Signal emitted when possible_digits changes."""
+        return self.puzzle._signal(self.index)
+
+    @property
+    def current_value(self):
+        """Return the square's digit, or None."""
+        value = self.puzzle._values[self.index]
+        return self.puzzle.topology.digits[value - 1] if value else None
+
+    @property
+    def solved_value(self):
+        """Return the square's digit in the solution, or None."""
+        value = self.puzzle._solved[self.index]
+        return self.puzzle.topology.digits[value - 1] if value else None
+
+    @solved_value.setter
+    def solved_value(self, digit):
+        self.puzzle._solved[self.index] = (
+            self.puzzle.topology.digit_index[digit] + 1 if digit else 0)
+
+    @property
+    def was_assigned(self):
+        """Return True if the square's value was assigned, not updated."""
+        return bool(self.puzzle._assigned[self.index])
+
+    @was_assigned.setter
+    def was_assigned(self, assigned):
+        self.puzzle._assigned[self.index] = bool(assigned)
 
     @property
     def is_solved(self):
@@ -468,53 +3515,845 @@ class Square(object):
                 self.solved_value is not None)
 
     def update(self, digit):
-        """Update square with the value of digit."""
+        """Update square with the value of digit.
+
+        Return list of the squares whose possible digits changed."""
         if self.was_assigned:
             raise SquareUpdateError(
                 'Cannot update a square whose value was asssigned')
-        self._update(digit)
+        squares = self.puzzle.squares
+        return [squares[i] for i in self.puzzle._edit(self.index, digit)]
 
     def _assign(self, digit):
         """Assign digit to square."""
-        self._update(digit)
+        changed = self._update(digit)
         self.was_assigned = True
+        return changed
 
     def _assign_random_digit(self):
         """Assign random digit from possible digits for the square."""
-        self._assign(random.choice(self.possible_digits))
+        self._assign(random.choice(sorted(self.possible_digits)))
 
     def _update(self, digit):
-        """Update square with the value of digit."""
-        if digit:
-            self.current_value = digit
-        else:
-            self.current_value = None
-        self._update_possible_digits()
-        for peer in self.peers:
-            peer._update_possible_digits()
+        """Update square with the value of digit.
 
-    def _reset(self):
-        """Reset the square back to a clean slate."""
-        self.possible_digits = DIGITS
-        self.current_value = None
-        self.solved_value = None
-        self.was_assigned = False
-
-    def _setup_peers(self):
-        """Determine the set of squares that are peers of this square."""
-        others = self.row.squares + self.column.squares + self.box.squares
-        self.peers = set(others) - {self}
-
-    def _update_possible_digits(self):
-        """Recalculate the possible digits for this square."""
-        if self.current_value:
-            self.possible_digits = {self.current_value}
+        Return list of the squares whose possible digits changed, in
+        order."""
+        squares = self.puzzle.squares
+        return [squares[i] for i in self.puzzle._update(self.index, digit)]
+
+
+class SolutionCache(object):
+    """Least recently used cache of solutions keyed by canonical form.
+
+    A grid that is a relabeling, transposition or row and column
+    reordering of one solved before is answered from the cache, with the
+    transform applied to the cached solutions. The cache holds at most
+    max_size grids, and if max_bytes is given, roughly that many bytes."""
+
+    def __init__(self, max_size=10000, max_bytes=None):
+        """Create a SolutionCache instance."""
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """Return fraction of lookups answered from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def clear(self):
+        """Remove all cached solutions and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.nbytes = 0
+
+    def solve(self, grid, max_solutions=None):
+        """Return list of up to max_solutions solutions for grid."""
+        canonical_grid, transform = canonical_form(grid)
+        key = (canonical_grid, max_solutions)
+        with self._lock:
+            solutions = self._entries.get(key)
+            if solutions is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if solutions is None:
+            solutions = _solve_one(canonical_grid, max_solutions)
+            self._add(key, solutions)
+        return [from_canonical(solution, transform) for solution in solutions]
+
+    def stats(self):
+        """Return dictionary of counters for the cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hit_rate, 'size': len(self._entries),
+                    'bytes': self.nbytes}
+
+    @staticmethod
+    def _entry_bytes(solutions):
+        """Return rough number of bytes used by a cache entry."""
+        return 200 + 130 * (1 + len(solutions))
+
+    def _add(self, key, solutions):
+        """Add solutions, evicting the least recently used as needed."""
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = solutions
+            self.nbytes += self._entry_bytes(solutions)
+            while self._entries and (
+                    len(self._entries) > self.max_size or
+                    self.max_bytes is not None and
+                    self.nbytes > self.max_bytes):
+                old_key, old_solutions = self._entries.popitem(last=False)
+                self.nbytes -= self._entry_bytes(old_solutions)
+
+
+class SearchPool(object):
+    """Worker processes for solve_parallel() and count_solutions_parallel(),
+    kept from one call to the next.
+
+    The processes are started by the first search. They share an event
+    that is set to stop them once a search has found what it wants, and
+    cleared before the next search, so searches on one pool take turns."""
+
+    def __init__(self, workers=None):
+        """Create a SearchPool instance."""
+        self.workers = workers or os.cpu_count() or 1
+        self._cancel = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _search(self, boards, wanted, counting):
+        """Return the results of _parallel_subtree for each of boards,
+        searched until wanted solutions have been found."""
+        import concurrent.futures
+        import multiprocessing
+        results = [None] * len(boards)
+        found = 0
+        with self._lock:
+            if self._executor is None:
+                self._cancel = multiprocessing.Event()
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, initializer=_parallel_init,
+                    initargs=(self._cancel,))
+            self._cancel.clear()
+            futures = {self._executor.submit(_parallel_subtree, board,
+                                             wanted, counting): k
+                       for k, board in enumerate(boards)}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    result = results[futures[future]] = future.result()
+                    found += result if counting else len(result)
+                    if wanted is not None and found >= wanted:
+                        break
+            finally:
+                # Stop the workers still searching, and wait for them to
+                # finish (which they soon do) before the event is cleared.
+                self._cancel.set()
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+        return results
+
+
+class SearchStats(object):
+    """Counters for the work done by solve() and random_grid().
+
+    Pass an instance as the stats argument to have it filled in. Counts
+    add up across calls until reset(). If callback is given, it is called
+    with the instance whenever a solve() or random_grid() call finishes.
+    The strategy_hits counter holds the digits each strategy eliminated."""
+
+    FIELDS = ('assignments', 'eliminations', 'contradictions', 'nodes',
+              'backtracks', 'max_depth', 'attempts', 'failed_attempts')
+
+    def __init__(self, callback=None):
+        """Create a SearchStats instance with all counters at zero."""
+        self.callback = callback
+        self.reset()
+
+    def __repr__(self):
+        return '<SearchStats %s>' % ' '.join(
+            '%s:%s' % (name, getattr(self, name)) for name in self.FIELDS)
+
+    def as_dict(self):
+        """Return dictionary of {counter_name: count} pairs."""
+        counts = {name: getattr(self, name) for name in self.FIELDS}
+        counts['strategy_hits'] = dict(self.strategy_hits)
+        return counts
+
+    def reset(self):
+        """Set all counters back to zero."""
+        for name in self.FIELDS:
+            setattr(self, name, 0)
+        self.strategy_hits = collections.Counter()
+
+    def _count_trail(self, board, trail, mark):
+        """Count the eliminations on trail since mark, and the squares
+        they left with a single possible digit."""
+        self.eliminations += len(trail) - mark
+        self.assignments += len({i for i, mask in trail[mark:]
+                                 if MASK_COUNTS[board[i]] == 1})
+
+    def _finished(self):
+        """Report the counts to the callback, if there is one."""
+        if self.callback is not None:
+            self.callback(self)
+
+
+class AsyncRunner(object):
+    """Runs blocking jobs on an executor for asyncio, a few at a time.
+
+    No more than max_jobs of the runner's jobs run at once (per event
+    loop), so give each tenant its own runner to stop one from saturating
+    an executor they share. Without an executor, the runner makes a thread
+    pool of its own with max_jobs workers. Jobs are cancelled by setting
+    a threading.Event, so the executor must run them in threads."""
+
+    def __init__(self, executor=None, max_jobs=4):
+        """Create an AsyncRunner instance."""
+        if max_jobs < 1:
+            raise ValueError('max_jobs must be at least 1, not %r.'
+                             % (max_jobs,))
+        self.executor = executor
+        self.max_jobs = max_jobs
+        self._own_executor = None
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def close(self):
+        """Shut down the runner's own thread pool, if it made one."""
+        if self._own_executor is not None:
+            self._own_executor.shutdown(wait=False, cancel_futures=True)
+            self._own_executor = None
+
+    async def run(self, function, *args, **kwargs):
+        """Return function(*args, cancel=event, **kwargs) run on the executor.
+
+        If the task awaiting it is cancelled, event is set so the function
+        can stop (as solve() and random_grid() do), and the job keeps its
+        place until it has."""
+        import asyncio
+        async with self._semaphore():
+            cancel = threading.Event()
+            future = self._executor().submit(function, *args, cancel=cancel,
+                                             **kwargs)
+            try:
+                return await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                cancel.set()
+                stopped = asyncio.wrap_future(future)
+                await asyncio.wait([stopped])
+                if not stopped.cancelled():
+                    # Retrieve the SearchCancelled, so it isn't logged.
+                    stopped.exception()
+                raise
+
+    def _executor(self):
+        """Return the executor the jobs are submitted to."""
+        import concurrent.futures
+        if self.executor is not None:
+            return self.executor
+        if self._own_executor is None:
+            self._own_executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_jobs)
+        return self._own_executor
+
+    def _semaphore(self):
+        """Return the semaphore limiting jobs on the running event loop."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_jobs)
+        return semaphore
+
+
+class PackedGrids(object):
+    """The grids of a file written by write_packed(), memory-mapped.
+
+    Indexing or iterating gives each grid as a packed record: a read-only
+    memoryview into the file, with no copying, that solve(), solve_many()
+    and the other grid functions accept as is. Release any views kept
+    before calling close()."""
+
+    def __init__(self, path):
+        """Open the packed file at path."""
+        import mmap
+        with open(path, 'rb') as f:
+            self._mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self._mapped[:PACKED_HEADER_BYTES]
+        if (len(header) < PACKED_HEADER_BYTES or
+                header[:4] != PACKED_MAGIC or header[4] != PACKED_VERSION):
+            self._mapped.close()
+            raise ValueError('%r is not a packed grid file.' % (path,))
+        self.has_solutions = bool(header[5] & 1)
+        self._record_bytes = PACKED_GRID_BYTES * (2 if self.has_solutions
+                                                  else 1)
+        size = len(self._mapped) - PACKED_HEADER_BYTES
+        if size % self._record_bytes:
+            self._mapped.close()
+            raise ValueError('%r ends part way through a grid.' % (path,))
+        self._count = size // self._record_bytes
+        self._view = memoryview(self._mapped)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, n):
+        return self._record(n, 0)
+
+    def __iter__(self):
+        for n in range(self._count):
+            yield self._record(n, 0)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        """Unmap the file."""
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            self._mapped.close()
+
+    def pairs(self):
+        """Generate (grid, solution) record pairs."""
+        for n in range(self._count):
+            yield self._record(n, 0), self.solution(n)
+
+    def solution(self, n):
+        """Return the solution record stored with the nth grid."""
+        if not self.has_solutions:
+            raise ValueError('The file has no solutions.')
+        return self._record(n, PACKED_GRID_BYTES)
+
+    def texts(self, solutions=False):
+        """Generate each grid as text, or (grid, solution) text pairs."""
+        if solutions:
+            for grid, solution in self.pairs():
+                yield unpack_grid(grid), unpack_grid(solution)
         else:
-            peer_digits = {peer.current_value for peer in self.peers}
-            self.possible_digits = DIGITS - peer_digits
-        self.possible_digits_changed.emit()
+            for grid in self:
+                yield unpack_grid(grid)
+
+    def _record(self, n, offset):
+        """Return view of the record at offset within the nth entry."""
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError('Grid index out of range.')
+        start = PACKED_HEADER_BYTES + n * self._record_bytes + offset
+        return self._view[start:start + PACKED_GRID_BYTES]
 
 
 class SquareUpdateError(Exception):
     """Cannot update a square whose value was assigned."""
     pass
+
+
+class SearchCancelled(Exception):
+    """The search was stopped by setting its cancel event."""
+    pass
+
+
+class BudgetExhausted(SearchCancelled):
+    """The search ran out of time, nodes or attempts.
+
+    The reason is 'deadline', 'max_nodes' or 'max_attempts', and stats is
+    a SearchStats holding the work done so far: the one passed in, or one
+    with just the nodes and attempts counted."""
+
+    def __init__(self, reason, stats):
+        super(BudgetExhausted, self).__init__(
+            'Search budget exhausted: %s reached.' % reason)
+        self.reason = reason
+        self.stats = stats
+
+
+class _SearchLimit(object):
+    """Checked by the search engines at each node, to stop them early.
+
+    The clock and the cancel event are only looked at every 64 nodes
+    (starting with the first), which keeps the check cheap."""
+
+    __slots__ = ('stats', 'cancel', 'deadline', 'max_nodes', 'max_attempts',
+                 'nodes', 'attempts')
+
+    def __init__(self, stats=None, cancel=None, deadline=None,
+                 max_nodes=None, max_attempts=None):
+        self.stats = stats
+        self.cancel = cancel
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.max_attempts = max_attempts
+        self.nodes = 0
+        self.attempts = 0
+
+    def check(self):
+        """Count a search node, or raise if the search should stop."""
+        if self.nodes == self.max_nodes:
+            raise self._exhausted('max_nodes')
+        self.nodes += 1
+        if self.nodes & 63 == 1:
+            self.check_time()
+
+    def check_attempt(self):
+        """Count an attempt, or raise if it shouldn't be made."""
+        if self.attempts == self.max_attempts:
+            raise self._exhausted('max_attempts')
+        self.check_time()
+        self.attempts += 1
+
+    def check_time(self):
+        """Raise if cancelled or past the deadline."""
+        if self.cancel is not None and self.cancel.is_set():
+            raise SearchCancelled('Search cancelled.')
+        if self.deadline is not None and time.time() > self.deadline:
+            raise self._exhausted('deadline')
+
+    def _exhausted(self, reason):
+        """Return the BudgetExhausted to raise for reason."""
+        stats = self.stats
+        if stats is None:
+            stats = SearchStats()
+            stats.nodes = self.nodes
+            stats.attempts = self.attempts
+        return BudgetExhausted(reason, stats)
+
+
+#==============================================================================
+# Benchmarks: python -m sudoku bench [options]
+#==============================================================================
+
+
+BENCHMARK_CORPORA = {
+    'easy': [
+        '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..',
+        '2...8.3...6..7..84.3.5..2.9...1.54.8.........4.27.6...3.1..7.4.72..4..6...4.1...3',
+    ],
+    'hard': [
+        '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+        '52...6.........7.13...........4..8..6......5...........418.........3..2...87.....',
+    ],
+    'test-hard': [
+        '........378.1...5.3....52...12.6..8...7.2.9...3..4.51...46....9.9...7.455........',
+        '..36.49......5....9.......72.......6.4.....5.8.......11.......5..........9273641.',
+        '...6..2..8.4.3.........9...4.5.....771.........3.5...83...7...4.....19.....2...6.',
+    ],
+    'near-empty': [
+        '.' * 81,
+        '1' + '.' * 79 + '2',
+        '.' * 40 + '5' + '.' * 40,
+    ],
+    'unsolvable': [
+        '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..',
+        '12345678.' + '........9' + '.' * 63,
+    ],
+}
+
+BENCHMARK_CLUES = (17, 26, 30, 40, 60, 80)
+
+BENCHMARK_COUNT_LIMIT = 1000
+
+
+def benchmark(seed=0, repeat=5, count=10, time_limit=30.0, names=None,
+              engine='bitmask'):
+    """Run the benchmark workloads and return the results as a dictionary.
+
+    Each corpus is solved (up to 2 solutions per grid, as a uniqueness
+    check would) repeat times, and with the engines count_solutions()
+    supports, has its solutions counted up to BENCHMARK_COUNT_LIMIT repeat
+    times. Each generation workload makes count random_grid() puzzles (by
+    either method), or Puzzle.setup_random_grid() puzzles, from a fixed
+    seed, giving up once time_limit seconds have passed. The puzzle-new
+    workload makes 100 * count empty puzzles. Workloads that don't depend
+    on the engine are only run with 'bitmask' (and random-grid with
+    'norvig', which has its own generator). Each workload reports the
+    bytes_each its results take up, such as the size of a Puzzle. Results
+    can be saved with json and compared later with compare_benchmarks()."""
+    import platform
+    _check_engine(engine)
+    results = {}
+    for name, function, items in _benchmark_workloads(repeat, count, engine):
+        if names and name not in names:
+            continue
+        random.seed(seed)
+        latencies, timed_out = _benchmark_latencies(function, items,
+                                                    time_limit)
+        random.seed(seed)
+        peak, retained = _benchmark_memory(function,
+                                           items[:min(3, len(items))],
+                                           time_limit)
+        total = sum(latencies)
+        results[name] = {
+            'count': len(latencies),
+            'timed_out': timed_out,
+            'seconds': total,
+            'per_second': len(latencies) / total if total else 0.0,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p90_ms': _percentile(latencies, 90) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies or [0.0]) * 1000,
+            'peak_kb': peak / 1024.0,
+            'bytes_each': retained,
+        }
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'engine': engine,
+        'seed': seed,
+        'workloads': results,
+    }
+
+
+def compare_benchmarks(results, baseline, tolerance=0.25):
+    """Return list of messages for workloads slower than in baseline.
+
+    A workload has regressed if its p50 latency is more than tolerance
+    (as a fraction) above the baseline, or its throughput is that much
+    below it."""
+    regressions = []
+    for name, old in sorted(baseline['workloads'].items()):
+        new = results['workloads'].get(name)
+        if not new or not new['count'] or not old['count']:
+            continue
+        if new['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            regressions.append('%s: p50 %.3f ms, was %.3f ms' % (
+                name, new['p50_ms'], old['p50_ms']))
+        if new['per_second'] < old['per_second'] * (1 - tolerance):
+            regressions.append('%s: %.1f per second, was %.1f' % (
+                name, new['per_second'], old['per_second']))
+    return regressions
+
+
+def fastest_engines(results):
+    """Return {workload: engine} for the fastest engine at each workload.
+
+    Results is a list of benchmark() results for different engines; an
+    engine is fastest at a workload if it has the lowest p50 latency of
+    those that finished it. Workloads that only one engine ran are left
+    out, as there is nothing to choose between."""
+    fastest = {}
+    engines = collections.defaultdict(set)
+    for result in results:
+        for name, workload in result['workloads'].items():
+            engines[name].add(result['engine'])
+            if not workload['count'] or workload['timed_out']:
+                continue
+            best = fastest.get(name)
+            if best is None or workload['p50_ms'] < best[0]:
+                fastest[name] = (workload['p50_ms'], result['engine'])
+    return {name: engine for name, (p50_ms, engine) in fastest.items()
+            if len(engines[name]) > 1}
+
+
+def _benchmark_count(grid, deadline, engine='bitmask'):
+    """Return the number of solutions for grid, up to a limit."""
+    return count_solutions(grid, BENCHMARK_COUNT_LIMIT, engine)
+
+
+def _benchmark_latencies(function, items, time_limit):
+    """Return (latencies, timed_out) for calling function on each item."""
+    deadline = time.time() + time_limit
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        if function(item, deadline) is None:
+            return latencies, True
+        latencies.append(time.perf_counter() - start)
+    return latencies, False
+
+
+def _benchmark_memory(function, items, time_limit):
+    """Return (peak, retained) bytes for calling function on each item.
+
+    Peak is the most allocated at once, and retained is the average bytes
+    still allocated per item while the results are all kept, such as the
+    size of each Puzzle made."""
+    import tracemalloc
+    deadline = time.time() + time_limit
+    results = []
+    tracemalloc.start()
+    try:
+        for item in items:
+            result = function(item, deadline)
+            if result is None:
+                break
+            results.append(result)
+        current, peak = tracemalloc.get_traced_memory()
+        return peak, current // max(len(results), 1)
+    finally:
+        tracemalloc.stop()
+
+
+def _benchmark_random_grid(clues, deadline, engine='bitmask'):
+    """Run random_grid's retry loop, or return None if past deadline."""
+    attempt = _random_grid if engine == 'norvig' else _bits_random_grid
+    result = False
+    while not result:
+        if time.time() > deadline:
+            return None
+        result = attempt(clues, True)
+    return result
+
+
+def _benchmark_dug_grid(clues, deadline):
+    """Make a random grid by digging holes."""
+    return random_grid(clues, True, method='dig')
+
+
+def _benchmark_new_puzzle(size, deadline):
+    """Return a new Puzzle of size."""
+    return Puzzle(size)
+
+
+def _benchmark_setup_random_grid(clues, deadline):
+    """Return a Puzzle setup with a random grid of at least clues squares."""
+    puzzle = Puzzle()
+    puzzle.setup_random_grid(clues)
+    return puzzle
+
+
+def _benchmark_sized_grid(size, deadline):
+    """Make a random grid of size, and solve it."""
+    grid, solution = random_grid(0, size=size)
+    return list(solve(grid, size=size))
+
+
+def _benchmark_solve(grid, deadline, engine='bitmask'):
+    """Return up to 2 solutions for grid."""
+    return _solve_one(grid, 2, engine)
+
+
+def _benchmark_workloads(repeat, count, engine):
+    """Return list of (name, function, items) benchmark workloads."""
+    solve_grid = functools.partial(_benchmark_solve, engine=engine)
+    make_grid = functools.partial(_benchmark_random_grid, engine=engine)
+    workloads = [('solve-' + name, solve_grid, grids * repeat)
+                 for name, grids in sorted(BENCHMARK_CORPORA.items())]
+    if engine in ('bitmask', 'dlx'):
+        count_grid = functools.partial(_benchmark_count, engine=engine)
+        workloads.extend(('count-' + name, count_grid, grids * repeat)
+                         for name, grids in sorted(BENCHMARK_CORPORA.items()))
+    # Workloads that would do the same work whatever the engine are only
+    # run for the bitmask engine, so fastest_engines() doesn't rank noise.
+    # Only the 'norvig' engine has a random grid generator of its own.
+    if engine in ('bitmask', 'norvig'):
+        workloads.extend(('random-grid-%d' % clues, make_grid,
+                          [clues] * count) for clues in BENCHMARK_CLUES)
+    if engine == 'bitmask':
+        workloads.extend(('dug-grid-%d' % clues, _benchmark_dug_grid,
+                          [clues] * count) for clues in BENCHMARK_CLUES)
+        workloads.extend(('size-%d-grid' % size, _benchmark_sized_grid,
+                          [size] * count) for size in SIZES if size != 9)
+        workloads.append(('puzzle-new', _benchmark_new_puzzle,
+                          [9] * count * 100))
+        workloads.append(('puzzle-setup-random-grid-40',
+                          _benchmark_setup_random_grid, [40] * count))
+    return workloads
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of values, or 0.0 if empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+#==============================================================================
+# Command line interface: python -m sudoku {solve,bench} [options]
+#==============================================================================
+
+
+def main(argv=None):
+    """Run the command line interface with argv (or sys.argv[1:])."""
+    import argparse
+    import mmap
+    parser = argparse.ArgumentParser(
+        prog='python -m sudoku',
+        description='Sudoku puzzle generator and solver.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    solver = commands.add_parser(
+        'solve',
+        help='solve puzzles, one per line',
+        description='Solve puzzles read one per line and write a solution, '
+        'or invalid, unsolvable or multiple, for each one.')
+    solver.add_argument(
+        'file', nargs='?', default='-',
+        help='file of puzzles to solve (default: read standard input)')
+    solver.add_argument(
+        '-w', '--workers', type=int, default=None,
+        help='number of worker processes (default: one per CPU)')
+    solver.add_argument(
+        '-c', '--chunksize', type=int, default=256,
+        help='puzzles sent to a worker at a time (default: 256)')
+    solver.add_argument(
+        '-o', '--order', choices=['input', 'completion'], default='input',
+        help='write a result for every line in input order (blank for a '
+        'blank line), or as they finish, prefixed by their line number '
+        '(default: input)')
+    solver.add_argument(
+        '-m', '--mmap', action='store_true',
+        help='read the file through a memory map')
+    bench = commands.add_parser(
+        'bench',
+        help='run the benchmark suite',
+        description='Time the benchmark workloads and write the results as '
+        'JSON, optionally flagging regressions against a saved baseline.')
+    bench.add_argument(
+        '-o', '--output', default='-',
+        help='file to write JSON results to (default: standard output)')
+    bench.add_argument(
+        '-b', '--baseline',
+        help='JSON results to compare against; exit with status 1 if any '
+        'workload has regressed')
+    bench.add_argument(
+        '-t', '--tolerance', type=float, default=0.25,
+        help='fraction a workload may slow down by (default: 0.25)')
+    bench.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='random seed for the generation workloads (default: 0)')
+    bench.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='times to solve each corpus (default: 5)')
+    bench.add_argument(
+        '-n', '--count', type=int, default=10,
+        help='puzzles to make per generation workload (default: 10)')
+    bench.add_argument(
+        '-l', '--time-limit', type=float, default=30.0,
+        help='seconds before a workload gives up (default: 30)')
+    bench.add_argument(
+        '-e', '--engine', choices=sorted(ENGINES), action='append',
+        help='engine to benchmark, repeat to compare engines and report '
+        'the fastest at each workload (default: bitmask)')
+    bench.add_argument(
+        'workloads', nargs='*',
+        help='names of workloads to run (default: all)')
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        return _cli_bench(args)
+    if args.file == '-':
+        _cli_solve(_cli_lines(sys.stdin.buffer), args)
+    elif args.mmap and os.path.getsize(args.file):
+        # An empty file can't be mapped, so it is read as any other.
+        with open(args.file, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                _cli_solve(_cli_lines(iter(mapped.readline, b'')), args)
+            finally:
+                mapped.close()
+    else:
+        with open(args.file, 'rb') as f:
+            _cli_solve(_cli_lines(f), args)
+    return 0
+
+
+def _cli_bench(args):
+    """Run the benchmarks, write the results and compare with a baseline.
+
+    With several engines, write {'runs': [results, ...], 'fastest': {...}}.
+    The baseline can hold either shape, and each run is compared with the
+    baseline run for the same engine."""
+    import json
+    runs = [benchmark(args.seed, args.repeat, args.count, args.time_limit,
+                      args.workloads, engine)
+            for engine in args.engine or ['bitmask']]
+    if len(runs) == 1:
+        output = runs[0]
+    else:
+        output = {'runs': runs, 'fastest': fastest_engines(runs)}
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baselines = {old.get('engine', 'bitmask'): old
+                     for old in baseline.get('runs', [baseline])}
+        pairs = [(run, baselines[run['engine']]) for run in runs
+                 if run['engine'] in baselines]
+        if not pairs:
+            if len(runs) > 1 or len(baselines) > 1:
+                sys.stderr.write('The baseline has no run for the engines '
+                                 'benchmarked.\n')
+                return 2
+            # A single run is compared with a single baseline as is.
+            pairs = [(runs[0], baseline)]
+        regressions = []
+        for results, old in pairs:
+            prefix = '%s ' % results['engine'] if len(runs) > 1 else ''
+            regressions.extend(
+                prefix + message for message in
+                compare_benchmarks(results, old, args.tolerance))
+        for message in regressions:
+            sys.stderr.write('Regression: %s\n' % message)
+        if regressions:
+            return 1
+    return 0
+
+
+def _cli_lines(raw_lines):
+    """Generate text lines for raw byte lines, whatever bytes they hold.
+
+    Undecodable bytes are replaced, so their line is reported as invalid
+    rather than stopping the run."""
+    for line in raw_lines:
+        yield line.decode('ascii', 'replace')
+
+
+def _cli_solve(lines, args):
+    """Check each line and write the results to stdout.
+
+    In input order there is one output line for each input line, which is
+    blank for a blank line. Otherwise blank lines are skipped and results
+    are prefixed by their line number."""
+    ordered = args.order == 'input'
+    numbered = ((n, line) for n, line in enumerate(lines, 1)
+                if ordered or line.strip())
+    results = _pool_map(_check_numbered_grid, numbered, args.workers,
+                        args.chunksize, ordered)
+    write = sys.stdout.write
+    for k, (n, result) in results:
+        if ordered:
+            write(result + '\n')
+        else:
+            write('%d %s\n' % (n, result))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import inspect
+import json
+import sys
+import threading
+import time
+
 import pytest
 import sudoku as su
 
@@ -279,3 +285,864 @@ def test_Puzzle_setup_random_grid_80():
     all_solutions = list(su.solve(p.assigned_grid))
     assert len(all_solutions) == 1
     assert all_solutions[0] == p.solved_grid
+
+
+def test_solve_engines_agree():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert (list(su.solve(grid, engine='bitmask')) ==
+            list(su.solve(grid, engine='norvig')))
+
+
+def test_solve_dlx_engine():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert (sorted(su.solve(grid, engine='dlx')) ==
+            sorted(su.solve(grid, engine='bitmask')))
+    grid = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    assert list(su.solve(grid, engine='dlx')) == list(su.solve(grid))
+    bad_grid = '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..'
+    assert list(su.solve(bad_grid, engine='dlx')) == []
+    assert list(su.solve('747' + '.' * 78, engine='dlx')) == []
+
+
+def test_dlx_links_threads():
+    # Threads building the template at once leave it whole.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for trial in range(10):
+            del su._DLX_TEMPLATE[:]
+            threads = [threading.Thread(target=su._dlx_links)
+                       for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(su._DLX_TEMPLATE) == 6
+    finally:
+        sys.setswitchinterval(interval)
+    assert su.is_valid(next(su.solve('.' * 81, engine='dlx')))
+
+
+def test_solve_unknown_engine():
+    with pytest.raises(ValueError):
+        list(su.solve('.' * 81, engine='nope'))
+
+
+def test_grid_map_propogated_engines_agree():
+    grid = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    assert (su._grid_map_propogated(grid, 'bitmask') ==
+            su._grid_map_propogated(grid, 'norvig'))
+
+
+def test_random_grid_engines_agree():
+    import random
+    random.seed(1234)
+    expected = su.random_grid(30, engine='norvig')
+    random.seed(1234)
+    assert su.random_grid(30, engine='bitmask') == expected
+
+
+def test_bits_solve_undoes_trail():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    board = su._bits_propagated(grid)
+    before = board[:]
+    trail = []
+    solutions = [su._bits_to_grid(b) for b in su._bits_solve(board, trail)]
+    assert len(solutions) == 4
+    assert board == before
+    assert trail == []
+
+
+def test_solve_many():
+    grids = [
+        '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+        'not a grid',
+        '747' + '.' * 78,
+        '027800061000030008910005420500016030000970200070000096700000080006027000030480007',
+    ]
+    results = list(su.solve_many(grids, workers=2, chunksize=1))
+    assert results[0] == ['417369825632158947958724316825437169791586432346912758289643571573291684164875293']
+    assert results[1] is None
+    assert results[2] == []
+    assert len(results[3]) == 4
+    assert list(su.solve_many(grids, workers=1, max_solutions=2))[3] == results[3][:2]
+    assert list(su.solve_many([None, 42], workers=1)) == [None, None]
+
+
+def test_solve_batch():
+    pytest.importorskip('numpy')
+    grids = [
+        '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+        '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..',
+        'not a grid',
+        '747' + '.' * 78,
+        '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..',
+        '027800061000030008910005420500016030000970200070000096700000080006027000030480007',
+    ]
+    expected = list(su.solve_many(grids, workers=1))
+    assert list(su.solve_batch(grids, block_size=4)) == expected
+    assert list(su.solve_batch(grids, max_solutions=1)) == [
+        solutions and solutions[:1] for solutions in expected]
+    # Packed records are read straight into the arrays, and a record with
+    # a square over 9 is malformed.
+    packed = [grid if n == 2 else su.pack_grid(grid)
+              for n, grid in enumerate(grids)] + [b'\xff' * 41]
+    assert list(su.solve_batch(packed, block_size=4)) == expected + [None]
+
+
+def test_main_solve(tmpdir, capsys):
+    puzzles = tmpdir.join('puzzles.txt')
+    puzzles.write('\n'.join([
+        '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+        '',
+        'junk \xe9',
+        '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..',
+        '027800061000030008910005420500016030000970200070000096700000080006027000030480007',
+    ]).encode('latin-1'), 'wb')
+    expected = ['417369825632158947958724316825437169791586432346912758289643571573291684164875293',
+                'invalid', 'unsolvable', 'multiple']
+    assert su.main(['solve', '--workers', '2', '--chunksize', '1',
+                    str(puzzles)]) == 0
+    assert capsys.readouterr()[0].split('\n') == (
+        expected[:1] + [''] + expected[1:] + [''])
+    su.main(['solve', '--mmap', '--order', 'completion', str(puzzles)])
+    lines = capsys.readouterr()[0].splitlines()
+    assert sorted(lines) == sorted(
+        '%d %s' % pair for pair in zip([1, 3, 4, 5], expected))
+    empty = tmpdir.join('empty.txt')
+    empty.write('')
+    assert su.main(['solve', '--mmap', str(empty)]) == 0
+    assert capsys.readouterr()[0] == ''
+
+
+def test_benchmark_and_compare():
+    results = su.benchmark(repeat=1, count=1, time_limit=5,
+                           names=['solve-easy', 'random-grid-60'])
+    assert sorted(results['workloads']) == ['random-grid-60', 'solve-easy']
+    easy = results['workloads']['solve-easy']
+    assert easy['count'] == 2
+    assert easy['p50_ms'] <= easy['p99_ms'] <= easy['max_ms']
+    assert easy['peak_kb'] > 0
+    assert su.compare_benchmarks(results, results) == []
+    faster = {'workloads': {'solve-easy': dict(easy, p50_ms=easy['p50_ms'] / 10,
+                                               per_second=easy['per_second'] * 10)}}
+    assert len(su.compare_benchmarks(results, faster)) == 2
+
+
+def test_main_bench_baseline(tmpdir):
+    output = tmpdir.join('bench.json')
+    args = ['bench', '-r', '1', '-n', '1', '-o', str(output), 'solve-easy']
+    assert su.main(args) == 0
+    assert su.main(args + ['-b', str(output), '-t', '100']) == 0
+    # Results for several engines are compared run by run.
+    runs = tmpdir.join('runs.json')
+    args = ['bench', '-r', '1', '-n', '1', '-e', 'bitmask', '-e', 'dlx',
+            '-o', str(runs), 'solve-easy']
+    assert su.main(args) == 0
+    assert su.main(args + ['-b', str(runs), '-t', '100']) == 0
+    assert su.main(['bench', '-r', '1', '-n', '1', '-e', 'dlx', '-o',
+                    str(output), '-b', str(runs), '-t', '100',
+                    'solve-easy']) == 0
+    assert su.main(['bench', '-r', '1', '-n', '1', '-e', 'norvig', '-o',
+                    str(output), '-b', str(runs), 'solve-easy']) == 2
+
+
+def test_solve_stats():
+    reports = []
+    stats = su.SearchStats(callback=reports.append)
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert len(list(su.solve(grid, stats=stats))) == 4
+    assert reports == [stats]
+    assert stats.nodes > 1
+    assert stats.backtracks > 0
+    assert stats.max_depth > 1
+    assert stats.eliminations > stats.assignments > 0
+    assert stats.attempts == 0
+    stats.reset()
+    counts = stats.as_dict()
+    assert counts.pop('strategy_hits') == {}
+    assert set(counts.values()) == {0}
+    with pytest.raises(ValueError):
+        list(su.solve(grid, engine='norvig', stats=stats))
+
+
+def test_random_grid_stats():
+    stats = su.SearchStats()
+    su.random_grid(30, stats=stats)
+    assert stats.attempts == stats.failed_attempts + 1
+    assert stats.nodes > 0
+
+
+def test_count_solutions():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert su.count_solutions(grid) == 4
+    assert su.count_solutions(grid, limit=2) == 2
+    assert su.count_solutions('747' + '.' * 78) == 0
+    assert su.count_solutions('.' * 81, limit=100) == 100
+    bad_grid = '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..'
+    assert su.count_solutions(bad_grid) == 0
+
+
+def test_count_solutions_dlx():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert su.count_solutions(grid, engine='dlx') == 4
+    assert su.count_solutions('.' * 81, limit=100, engine='dlx') == 100
+    with pytest.raises(ValueError):
+        su.count_solutions(grid, engine='norvig')
+
+
+def test_fastest_engines():
+    results = [su.benchmark(repeat=1, count=1, time_limit=5, engine=engine,
+                            names=['solve-easy', 'count-easy'])
+               for engine in ('bitmask', 'dlx')]
+    fastest = su.fastest_engines(results)
+    assert sorted(fastest) == ['count-easy', 'solve-easy']
+    assert set(fastest.values()) <= {'bitmask', 'dlx'}
+    # Engine independent workloads are only run once, and not ranked.
+    names = ['solve-easy', 'random-grid-60', 'puzzle-new']
+    results = [su.benchmark(repeat=1, count=1, time_limit=5, engine=engine,
+                            names=names)
+               for engine in ('bitmask', 'dlx', 'norvig')]
+    assert sorted(results[0]['workloads']) == sorted(names)
+    assert sorted(results[1]['workloads']) == ['solve-easy']
+    assert sorted(su.fastest_engines(results)) == ['random-grid-60',
+                                                    'solve-easy']
+
+
+def test_has_unique_solution():
+    grid = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    assert su.has_unique_solution(grid)
+    assert not su.has_unique_solution('.' * 81)
+    assert not su.has_unique_solution('747' + '.' * 78)
+
+
+def test_random_grid_dig():
+    grid, solution = su.random_grid(17, method='dig')
+    assert su.has_unique_solution(grid)
+    assert list(su.solve(grid)) == [solution]
+    assert all(g in ('.', s) for g, s in zip(grid, solution))
+    assert all((grid[i] == '.') == (grid[80 - i] == '.') for i in range(81))
+    assert 17 <= 81 - grid.count('.') < 40
+
+
+def test_random_grid_dig_60():
+    grid, solution = su.random_grid(60, symmetrical=False, method='dig')
+    assert 81 - grid.count('.') == 60
+    assert list(su.solve(grid)) == [solution]
+
+
+def test_random_grid_unknown_method():
+    with pytest.raises(ValueError):
+        su.random_grid(30, method='nope')
+
+
+def test_Puzzle_setup_random_grid_dig_20():
+    p = su.Puzzle()
+    p.setup_random_grid(20, method='dig')
+    all_solutions = list(su.solve(p.assigned_grid))
+    assert all_solutions == [p.solved_grid]
+
+
+def test_PuzzlePool(tmpdir):
+    with su.PuzzlePool(low_water=1, high_water=3, workers=2) as pool:
+        for future in pool.fill(60, True):
+            future.result()
+        while pool.stats()['pending']:
+            # Done callbacks can run just after result() returns.
+            time.sleep(0.01)
+        assert len(pool) == 3
+        p = su.Puzzle()
+        p.setup_random_grid(60, pool=pool)
+        assert list(su.solve(p.assigned_grid)) == [p.solved_grid]
+        grid, solution = pool.get(70, False)
+        assert list(su.solve(grid)) == [solution]
+        stats = pool.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['refills'] >= 3
+        assert stats['max_refill_seconds'] > 0
+        path = str(tmpdir.join('pool.json'))
+        pool.save(path)
+    with open(path) as f:
+        ready = sum(len(pairs) for pairs in json.load(f).values())
+    # Threads refilling at once share one executor and don't overfill.
+    with su.PuzzlePool(low_water=1, high_water=4, workers=2) as pool:
+        submitted = []
+        threads = [threading.Thread(target=lambda: submitted.extend(
+                       pool.fill(70, True))) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(submitted) == 4
+        for future in submitted:
+            future.result()
+    other = su.PuzzlePool()
+    other.load(path)
+    assert len(other) == ready
+    assert other.get(60, True)
+    assert other.hits == 1
+    other.close()
+
+
+def _transformed(grid):
+    """Return grid relabeled, transposed and with rows and columns moved."""
+    relabel = dict(zip('123456789', '972351864'), **{'.': '.'})
+    rows = [5, 3, 4, 0, 2, 1, 7, 8, 6]
+    columns = [3, 5, 4, 8, 6, 7, 1, 2, 0]
+    return ''.join(relabel[grid[9 * c + r]] for r in rows for c in columns)
+
+
+def test_canonical_form():
+    grid = su.normalize('4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......')
+    canonical_grid, transform = su.canonical_form(grid)
+    assert su.from_canonical(canonical_grid, transform) == grid
+    other = _transformed(grid)
+    other_canonical_grid, other_transform = su.canonical_form(other)
+    assert other_canonical_grid == canonical_grid
+    assert su.from_canonical(other_canonical_grid, other_transform) == other
+
+
+def test_SolutionCache():
+    grid = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    solution = '417369825632158947958724316825437169791586432346912758289643571573291684164875293'
+    cache = su.SolutionCache(max_size=2)
+    assert cache.solve(grid) == [solution]
+    assert cache.solve(_transformed(grid)) == [_transformed(solution)]
+    assert cache.hits == 1
+    assert cache.hit_rate == 0.5
+    cache.solve('.' * 81, max_solutions=1)
+    cache.solve('747' + '.' * 78)
+    assert len(cache) == 2
+    assert cache.solve(grid) == [solution]
+    assert cache.stats()['misses'] == 4
+    small = su.SolutionCache(max_bytes=1000)
+    for n in range(1, 10):
+        small.solve(str(n) + '.' * 80, max_solutions=1)
+    assert 0 < small.nbytes <= 1000
+
+
+def test_solve_iterative():
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert list(su.solve(grid, engine='iterative')) == list(su.solve(grid))
+    assert (su._grid_map_propogated(grid, 'iterative') ==
+            su._grid_map_propogated(grid, 'bitmask'))
+    hard_grid = '...6..2..8.4.3.........9...4.5.....771.........3.5...83...7...4.....19.....2...6.'
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + 20)
+    try:
+        all_solutions = list(su.solve(hard_grid, engine='iterative'))
+    finally:
+        sys.setrecursionlimit(limit)
+    assert all_solutions == list(su.solve(hard_grid))
+
+
+def test_solve_strategies():
+    hard_grid = '...6..2..8.4.3.........9...4.5.....771.........3.5...83...7...4.....19.....2...6.'
+    plain = su.SearchStats()
+    expected = list(su.solve(hard_grid, stats=plain))
+    for name in su.STRATEGIES:
+        assert list(su.solve(hard_grid, strategies=[name])) == expected
+    stats = su.SearchStats()
+    assert list(su.solve(hard_grid, stats=stats, strategies='all')) == expected
+    assert stats.nodes < plain.nodes
+    assert set(stats.strategy_hits) <= set(su.STRATEGIES)
+    assert sum(stats.strategy_hits.values()) > 0
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    assert (sorted(su.solve(grid, strategies='all')) ==
+            sorted(su.solve(grid)))
+    with pytest.raises(ValueError):
+        list(su.solve(grid, strategies=['guessing']))
+    with pytest.raises(ValueError):
+        list(su.solve(grid, engine='norvig', strategies='all'))
+
+
+def test_random_grid_strategies():
+    import random
+    random.seed(99)
+    expected = su.random_grid(30)
+    random.seed(99)
+    assert su.random_grid(30, strategies='all') == expected
+
+
+def test_rate():
+    easy = '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    easy_score, easy_technique = su.rate(easy)
+    hard_score, hard_technique = su.rate(hard)
+    assert easy_technique == 'naked_single'
+    assert hard_technique not in ('naked_single', 'hidden_single')
+    assert hard_score > easy_score
+    assert su.rate(_transformed(hard)) == (hard_score, hard_technique)
+    assert su.rate('.' * 81) is None
+    assert su.rate('747' + '.' * 78) is None
+    bad_grid = '..235..47..54...63.4.92..8.38.19.27.2.6...8.4.54.83.19.3..76.2.87...19..62..481..'
+    assert su.rate(bad_grid) is None
+
+
+def test_rate_many():
+    grids = [
+        '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..',
+        'not a grid',
+        '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+    ]
+    assert list(su.rate_many(grids, workers=2, chunksize=1)) == [
+        su.rate(grids[0]), None, su.rate(grids[2])]
+
+
+def test_random_rated_grid():
+    grid, solution = su.random_rated_grid('hidden_single', workers=1)
+    assert su.rate(grid)[1] == 'hidden_single'
+    assert list(su.solve(grid)) == [solution]
+    with pytest.raises(ValueError):
+        su.random_rated_grid('guessing')
+    with pytest.raises(su.BudgetExhausted) as info:
+        su.random_rated_grid('x_wing', workers=1, max_attempts=3)
+    assert info.value.reason == 'max_attempts'
+    assert info.value.stats.attempts == 3
+    # Candidates made in this process don't reseed the caller's random.
+    state = su.random.getstate()
+    su._rated_dug_grid(0, 17, True)
+    assert su.random.getstate() == state
+
+
+def test_sizes_normalize_and_validate():
+    grid = '1.3..4....2..3.4'
+    assert su.normalize(grid.replace('.', '0'), size=4) == grid
+    assert su.is_valid(grid, size=4)
+    assert not su.is_valid('11' + '.' * 14, size=4)
+    assert su.normalize('a' + '.' * 255, size=16) == 'A' + '.' * 255
+    with pytest.raises(ValueError):
+        su.normalize(grid, size=16)
+    with pytest.raises(ValueError):
+        su.normalize(grid, size=5)
+
+
+def test_sizes_solve():
+    grid = '......12.1.3.32.'
+    assert list(su.solve(grid, size=4)) == ['1234341221434321']
+    assert su.count_solutions('.' * 16, size=4) == 288
+    assert list(su.solve('11' + '.' * 14, size=4)) == []
+    with pytest.raises(ValueError):
+        list(su.solve(grid, engine='dlx', size=4))
+
+
+def test_sizes_random_grid():
+    for size in (4, 16, 25):
+        grid, solution = su.random_grid(0, size=size)
+        assert len(grid) == size * size
+        assert list(su.solve(grid, size=size)) == [solution]
+    grid, solution = su.random_grid(0, size=16, method='dig')
+    assert su.count_solutions(grid, 2, size=16) == 1
+    # Filling in a solution doesn't recurse once per square.
+    depth = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        grid, solution = su.random_grid(625, size=25)
+    finally:
+        sys.setrecursionlimit(depth)
+    assert grid == solution and su.is_valid(solution, size=25)
+
+
+def test_Puzzle_size_16():
+    puzzle = su.Puzzle(16)
+    assert len(puzzle.squares) == 256
+    assert len(puzzle.squares[0].peers) == 39
+    puzzle.setup_random_grid(100)
+    assert len(puzzle.assigned_squares) >= 100
+    assert all(len(square.possible_digits) == 1
+               for square in puzzle.assigned_squares)
+    assert list(su.solve(puzzle.assigned_grid, size=16)) == [puzzle.solved_grid]
+
+
+def test_Square_update_reports_changed_squares():
+    puzzle = su.Puzzle()
+    first, second = puzzle.squares[0], puzzle.squares[1]
+    changed = first.update('5')
+    assert changed[0] is first
+    assert set(changed) == {first} | first.peers
+    assert second.possible_digits == su.DIGITS - {'5'}
+    # 5 is already in the row and box, so only the rest of the column changes.
+    changed = second.update('5')
+    assert set(changed) == {second} | set(second.column.squares) - set(first.box.squares)
+    changed = first.update(None)
+    assert set(changed) == {first} | set(first.column.squares) - set(first.box.squares)
+    assert '5' not in puzzle.squares[2].possible_digits
+    second.update(None)
+    assert puzzle.squares[2].possible_digits == su.DIGITS
+    assert first.update(None) == []
+
+
+def test_Puzzle_batch_update_signals():
+    puzzle = su.Puzzle()
+    first = puzzle.squares[0]
+    emitted = []
+    changes = []
+    for square in puzzle.squares:
+        square.possible_digits_changed.connect(
+            lambda square=square: emitted.append(square))
+    puzzle.squares_changed.connect(changes.append)
+    first.update('5')
+    assert len(emitted) == 21 and changes == [set(emitted)]
+    del emitted[:], changes[:]
+    # Nothing changes, so nothing is signalled.
+    first.update('5')
+    assert emitted == [] and changes == []
+    with puzzle.batch_update():
+        puzzle.squares[1].update('6')
+        first.update(None)
+        first.update('5')
+        puzzle.squares[1].update(None)
+        assert emitted == []
+    assert emitted == [] and changes == []
+    with puzzle.batch_update():
+        with puzzle.batch_update():
+            first.update('7')
+        assert emitted == []
+        first.update('8')
+    assert len(emitted) == 21 and len(set(emitted)) == 21
+    assert changes == [set(emitted)]
+    del emitted[:], changes[:]
+    before = su.Puzzle()
+    before.restore(puzzle.snapshot())
+    puzzle.setup_random_grid(80)
+    # Only the squares whose digits differ afterwards are signalled, once.
+    assert len(emitted) == len(set(emitted))
+    assert {square.index for square in emitted} == {
+        i for i, square in enumerate(puzzle.squares)
+        if square.possible_digits != before.squares[i].possible_digits}
+    assert len(changes) == 1
+
+
+def test_Puzzle_shares_topology():
+    puzzle, other = su.Puzzle(), su.Puzzle()
+    assert puzzle.topology is other.topology
+    assert not hasattr(puzzle, '__dict__')
+    square = puzzle.squares[40]
+    assert not hasattr(square, '__dict__')
+    assert (square.number, square.name) == (41, '41')
+    assert (square.row.number, square.column.number, square.box.number) == (5, 5, 5)
+    assert square in square.row.squares and square in square.box.squares
+    assert len(square.peers) == 20 and square not in square.peers
+    assert puzzle.mirror[puzzle.squares[0]] is puzzle.squares[80]
+    square.update('3')
+    assert square.current_value == '3'
+    assert square.row.digit_counts == {'3': 1}
+    assert square.box.present_digits == {'3'}
+    assert other.squares[41].possible_digits == su.DIGITS
+    square.solved_value = '3'
+    assert square.is_solved
+    results = su.benchmark(repeat=1, count=1, names=['puzzle-new'])
+    assert 0 < results['workloads']['puzzle-new']['bytes_each'] < 10000
+
+
+def test_Puzzle_snapshot_undo_redo():
+    import pickle
+    puzzle = su.Puzzle(history=3)
+    assert not puzzle.undo() and not puzzle.redo()
+    start = puzzle.snapshot()
+    assert pickle.loads(pickle.dumps(start)) == start
+    first, second = puzzle.squares[0], puzzle.squares[1]
+    first.update('1')
+    with puzzle.batch_update():
+        second.update('2')
+        first.update(None)
+    emitted = []
+    puzzle.squares_changed.connect(emitted.append)
+    assert puzzle.undo()
+    assert (first.current_value, second.current_value) == ('1', None)
+    assert len(emitted) == 1 and {first, second} <= emitted[0]
+    assert puzzle.undo()
+    assert puzzle.snapshot() == start
+    assert puzzle.redo() and puzzle.redo() and not puzzle.redo()
+    assert (first.current_value, second.current_value) == (None, '2')
+    # Restoring only signals squares that differ.
+    del emitted[:]
+    assert puzzle.restore(puzzle.snapshot()) == []
+    assert emitted == []
+    changed = puzzle.restore(start)
+    assert puzzle.snapshot() == start and set(changed) == emitted[0]
+    assert puzzle.undo() and second.current_value == '2'
+    # The history is bounded.
+    for square in puzzle.squares[20:24]:
+        square.update('3')
+    assert puzzle.undo() and puzzle.undo() and puzzle.undo()
+    assert not puzzle.undo()
+    puzzle.setup_random_grid(40)
+    grid = puzzle.current_grid
+    puzzle.reset()
+    assert puzzle.current_grid == '.' * 81
+    assert puzzle.undo() and puzzle.current_grid == grid
+    with pytest.raises(ValueError):
+        su.Puzzle(4).restore(start)
+    # Edits and snapshots in one batch_update() block keep their order.
+    puzzle = su.Puzzle()
+    squares = puzzle.squares
+    with puzzle.batch_update():
+        squares[0].update('1')
+        puzzle.reset()
+        squares[1].update('2')
+        assert puzzle.undo() and puzzle.current_grid == '.' * 81
+        assert puzzle.redo() and puzzle.current_grid == '.2' + '.' * 79
+    states = []
+    while puzzle.undo():
+        states.append(puzzle.current_grid[:2])
+    assert states == ['..', '1.', '..']
+
+
+def test_Puzzle_hints_and_conflicts():
+    import random
+    grid = '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..'
+    puzzle = su.Puzzle()
+    with puzzle.batch_update():
+        for i, digit in enumerate(grid):
+            if digit != '.':
+                puzzle.squares[i]._assign(digit)
+        for i, digit in enumerate(next(su.solve(grid))):
+            puzzle.squares[i].solved_value = digit
+    assert puzzle.conflicts() == []
+    square, digit, technique = puzzle.next_hint()
+    assert technique == 'naked_single' and digit == square.solved_value
+    assert puzzle.forced_cells()[square] == digit
+    # Follow the hints, which stay up to date, to solve the puzzle.
+    while not puzzle.is_solved:
+        square, digit, technique = puzzle.next_hint()
+        assert digit == square.solved_value
+        square.update(digit)
+    assert puzzle.next_hint() is None and puzzle.forced_cells() == {}
+    puzzle.undo()
+    square, digit, technique = puzzle.next_hint()
+    assert square.current_value is None
+    # Random updates, including conflicting ones, keep the state right.
+    random.seed(5)
+    empty = [square for square in puzzle.squares if not square.was_assigned]
+    for n in range(60):
+        square = random.choice(empty)
+        square.update(random.choice('123456789') if n % 3 else None)
+        fresh = su.Puzzle()
+        fresh.restore(puzzle.snapshot())
+        assert ([s.index for s in puzzle.conflicts()] ==
+                [s.index for s in fresh.conflicts()])
+        assert ({s.index: d for s, d in puzzle.forced_cells().items()} ==
+                {s.index: d for s, d in fresh.forced_cells().items()})
+        for s in puzzle.conflicts():
+            value = s.current_value
+            assert any([t.current_value for t in unit.squares].count(value) > 1
+                       for unit in (s.row, s.column, s.box))
+
+
+def test_search_cancel_event():
+    import threading
+    cancel = threading.Event()
+    cancel.set()
+    for engine in su.ENGINES:
+        with pytest.raises(su.SearchCancelled):
+            next(su.solve('.' * 81, engine, cancel=cancel))
+    with pytest.raises(su.SearchCancelled):
+        su.random_grid(cancel=cancel)
+    with pytest.raises(su.SearchCancelled):
+        su.random_grid(method='dig', cancel=cancel)
+    with pytest.raises(su.SearchCancelled):
+        su.random_grid(size=16, cancel=cancel)
+    assert len(next(su.solve('.' * 81, cancel=threading.Event()))) == 81
+
+
+def test_import_is_light():
+    # The Puzzle classes shouldn't pay for modules only some functions use.
+    import subprocess
+    code = ('import sys, sudoku; print(sorted({"argparse", "asyncio", '
+            '"concurrent.futures", "mmap", "multiprocessing", "numpy", '
+            '"tracemalloc"} & set(sys.modules)))')
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=su.os.path.dirname(su.__file__))
+    assert output.decode().strip() == '[]'
+
+
+def test_async_solve_and_random_grid():
+    import asyncio
+    grid = '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..'
+    runner = su.AsyncRunner(max_jobs=1)
+
+    async def main():
+        solutions = await su.async_solve(grid, runner=runner)
+        assert solutions == list(su.solve(grid))
+        assert len(await su.async_solve('.' * 16, 5, size=4)) == 5
+        # The timeout stops the search, which would otherwise run for
+        # ever, so the runner's only worker is free for the next job.
+        with pytest.raises(asyncio.TimeoutError):
+            await su.async_solve('.' * 81, timeout=0.1, runner=runner)
+        done = await asyncio.wait_for(
+            runner.run(lambda cancel: 'done'), 5)
+        assert done == 'done'
+        task = asyncio.ensure_future(
+            su.async_solve('.' * 81, engine='dlx', runner=runner))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert await asyncio.wait_for(
+            runner.run(lambda cancel: 'done'), 5) == 'done'
+        grid_, solution = await su.async_random_grid(30, runner=runner)
+        assert su.is_valid(grid_) and solution == next(su.solve(grid_))
+        puzzle = su.Puzzle()
+        await puzzle.async_setup_random_grid(40, runner=runner)
+        assert len(puzzle.assigned_squares) >= 40
+        assert puzzle.can_undo
+
+    try:
+        asyncio.run(main())
+    finally:
+        runner.close()
+
+
+def test_AsyncRunner_limits_jobs():
+    import asyncio
+    import threading
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def job(n, cancel):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return n
+
+    with pytest.raises(ValueError):
+        su.AsyncRunner(max_jobs=0)
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        runner = su.AsyncRunner(executor, max_jobs=2)
+
+        async def main():
+            return await asyncio.gather(*[runner.run(job, n)
+                                          for n in range(8)])
+
+        assert asyncio.run(main()) == list(range(8))
+        assert running[1] == 2
+
+
+def test_search_budgets():
+    for engine in su.ENGINES:
+        with pytest.raises(su.BudgetExhausted) as info:
+            list(su.solve('.' * 81, engine, max_nodes=300))
+        assert info.value.reason == 'max_nodes'
+        assert info.value.stats.nodes == 300
+    stats = su.SearchStats()
+    with pytest.raises(su.BudgetExhausted) as info:
+        list(su.solve('.' * 81, stats=stats, deadline=time.time() + 0.05))
+    assert info.value.reason == 'deadline' and info.value.stats is stats
+    assert stats.nodes > 0
+    with pytest.raises(su.BudgetExhausted) as info:
+        list(su.solve('.' * 256, size=16, max_nodes=10))
+    # Nodes are counted alike, from the propagated grid on.
+    grid = '027800061000030008910005420500016030000970200070000096700000080006027000030480007'
+    for engine in su.ENGINES:
+        with pytest.raises(su.BudgetExhausted):
+            list(su.solve(grid, engine, max_nodes=0))
+        if engine != 'dlx':
+            with pytest.raises(su.BudgetExhausted):
+                list(su.solve(grid, engine, max_nodes=6))
+            assert len(list(su.solve(grid, engine, max_nodes=7))) == 4
+    # A budget that is big enough changes nothing.
+    grid = '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..'
+    assert (list(su.solve(grid, max_nodes=1000, deadline=time.time() + 60))
+            == list(su.solve(grid)))
+    with pytest.raises(su.BudgetExhausted) as info:
+        su.random_grid(max_attempts=0)
+    assert info.value.reason == 'max_attempts'
+    assert info.value.stats.attempts == 0
+    with pytest.raises(su.BudgetExhausted) as info:
+        su.random_grid(size=25, method='dig', deadline=time.time())
+    assert info.value.reason == 'deadline'
+    assert su.random_grid(max_attempts=1000)
+    for kwargs in {'method': 'dig'}, {'size': 16}:
+        with pytest.raises(su.BudgetExhausted) as info:
+            su.random_grid(17, max_attempts=0, **kwargs)
+        assert info.value.reason == 'max_attempts'
+        assert su.random_grid(17, max_attempts=1, **kwargs)
+    with pytest.raises(ValueError):
+        list(su.solve(grid, max_nodes=-1))
+
+
+def test_packed_grids(tmp_path):
+    grid = '..3.2.6..9..3.5..1..18.64....81.29..7.......8..67.82....26.95..8..2.3..9..5.1.3..'
+    solution = next(su.solve(grid))
+    record = su.pack_grid(grid)
+    assert len(record) == su.PACKED_GRID_BYTES == 41
+    assert su.unpack_grid(record) == grid
+    assert su.unpack_grid(su.pack_grid(solution)) == solution
+    assert su.normalize(record) == grid
+    with pytest.raises(ValueError):
+        su.unpack_grid(b'\xff' * 41)
+    with pytest.raises(ValueError):
+        su.pack_grid(b'123')
+    grids = [grid, '.' * 81, solution]
+    path = str(tmp_path / 'grids.sdk')
+    assert su.write_packed(path, grids) == 3
+    with su.PackedGrids(path) as packed:
+        assert len(packed) == 3 and not packed.has_solutions
+        assert list(packed.texts()) == grids
+        view = packed[0]
+        assert isinstance(view, memoryview) and view.readonly
+        assert list(su.solve(view)) == [solution]
+        assert su.count_solutions(packed[-1]) == 1
+        assert su.rate(view) == su.rate(grid)
+        assert list(su.solve_many(packed, workers=1, max_solutions=1)) == [
+            [solution], [next(su.solve('.' * 81))], [solution]]
+        assert list(su.solve(view, 'iterative')) == [solution]
+        assert list(su.solve(su.pack_grid('11' + '.' * 79))) == []
+        assert su.count_solutions(view) == 1
+        with pytest.raises(ValueError):
+            packed.solution(0)
+        with pytest.raises(IndexError):
+            packed[3]
+        del view
+    path = str(tmp_path / 'pairs.sdk')
+    assert su.write_packed(path, [grid], [solution]) == 1
+    with su.PackedGrids(path) as packed:
+        assert list(packed.texts(solutions=True)) == [(grid, solution)]
+        assert su.unpack_grid(packed.solution(0)) == solution
+        assert list(su.solve_many(packed, workers=2)) == [[solution]]
+    with pytest.raises(ValueError):
+        su.write_packed(path, [grid, grid], [solution])
+    # The file that was there is left as it was, with no partial file.
+    with su.PackedGrids(path) as packed:
+        assert len(packed) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'grids.sdk', 'pairs.sdk']
+    with pytest.raises(ValueError):
+        su.write_packed(str(tmp_path / 'bad.sdk'), ['junk'])
+    assert not (tmp_path / 'bad.sdk').exists()
+    with open(path, 'wb') as f:
+        f.write(b'not packed')
+    with pytest.raises(ValueError):
+        su.PackedGrids(path)
+
+
+def test_solve_parallel():
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    assert su.solve_parallel(hard, workers=2) == list(su.solve(hard))
+    solution = next(su.solve('.' * 81))
+    grid = '.' * 24 + solution[24:]
+    solutions = list(su.solve(grid))
+    assert len(solutions) > 1
+    for workers in (1, 2):
+        assert su.solve_parallel(grid, None, workers) == solutions
+        assert su.count_solutions_parallel(grid, workers=workers) == len(
+            solutions)
+        assert su.count_solutions_parallel(grid, 2, workers) == 2
+        assert su.solve_parallel(grid, 1, workers)[0] in solutions
+    # The first solution stops the search of an empty grid's subtrees.
+    assert su.is_valid(su.solve_parallel('.' * 81, workers=2)[0])
+    assert su.count_solutions_parallel('.' * 81, 100, workers=2) == 100
+    assert su.solve_parallel('11' + '.' * 79, workers=2) == []
+    assert su.count_solutions_parallel(hard, 0) == 0
+    # A pool's processes are reused, and a search stopped early doesn't
+    # stop the next one.
+    with su.SearchPool(2) as pool:
+        assert su.count_solutions_parallel('.' * 81, 10, pool=pool) == 10
+        assert su.solve_parallel(grid, None, pool=pool) == solutions
+        assert su.count_solutions_parallel(grid, pool=pool) == len(solutions)